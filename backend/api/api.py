@@ -1,4 +1,5 @@
 import logging
+import time
 from contextlib import asynccontextmanager
 from time import sleep
 
@@ -10,6 +11,12 @@ from starlette.middleware.cors import CORSMiddleware
 
 import settings
 import api.healthchecker as hc
+from api.metrics import (
+    instrument_engine,
+    instrument_s3,
+    metrics_endpoint,
+    observe_request,
+)
 from infrastructure.postgres import database
 from .routers import auth_router, doc_router
 
@@ -55,7 +62,36 @@ app.state.Logger.setLevel("DEBUG")
 
 app.include_router(auth_router, prefix="/api")
 app.include_router(doc_router, prefix="/api")
+app.add_api_route("/metrics", metrics_endpoint, include_in_schema=False)
+
+instrument_engine(database.engine)
+
 
+@app.middleware("http")
+async def body_size_middleware(request: Request, call_next):
+    # Starlette spools the whole multipart body before the handler runs, so
+    # oversized uploads are turned away on the header; the handlers check
+    # the actual size of bodies sent without one
+    content_length = request.headers.get("content-length")
+    max_bytes = (
+        settings.app_settings.MAX_UPLOAD_BYTES
+        + settings.app_settings.MAX_FORM_OVERHEAD
+    )
+    if (
+        content_length
+        and content_length.isdigit()
+        and int(content_length) > max_bytes
+    ):
+        return JSONResponse(
+            content={"detail": "File is too large", "success": False},
+            status_code=413,
+        )
+
+    return await call_next(request)
+
+
+# registered after body_size_middleware, so that its 413 carries the CORS
+# headers too
 origins = ["*"]
 app.add_middleware(
     CORSMiddleware,
@@ -81,6 +117,7 @@ async def db_session_middleware(request: Request, call_next):
         aws_secret_access_key=settings.minio_settings.ROOT_PASSWORD,
     ) as s3_client:
         request.state.s3 = s3_client
+        instrument_s3(s3_client)
         try:
             response = await call_next(request)
         except Exception as exc:
@@ -99,3 +136,12 @@ async def db_session_middleware(request: Request, call_next):
             await request.state.db.close()
 
     return response
+
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    observe_request(request, response.status_code, time.perf_counter() - start)
+
+    return response
@@ -0,0 +1,77 @@
+import time
+
+from fastapi import Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+REQUEST_SECONDS = Histogram(
+    "api_request_duration_seconds",
+    "Latency of the API requests, by route template",
+    ["method", "route", "status"],
+)
+S3_SECONDS = Histogram(
+    "api_s3_call_duration_seconds",
+    "Latency of the S3 calls, by operation",
+    ["operation"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+DB_SECONDS = Histogram(
+    "api_db_query_duration_seconds",
+    "Latency of the Postgres statements, by statement type",
+    ["statement"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+UPLOAD_BYTES = Counter(
+    "api_upload_bytes_total",
+    "Size of the uploaded documents",
+    ["file_type"],
+)
+
+
+async def metrics_endpoint() -> Response:
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def observe_request(request: Request, status_code: int, secs: float) -> None:
+    # the path template keeps the number of label values bounded
+    route = request.scope.get("route")
+    REQUEST_SECONDS.labels(
+        request.method, route.path if route else "unmatched", str(status_code)
+    ).observe(secs)
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """Time every statement executed by the engine."""
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        secs = time.perf_counter() - conn.info["query_start"].pop()
+        DB_SECONDS.labels(statement.split(None, 1)[0].upper()).observe(secs)
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def _on_error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_start"):
+            conn.info["query_start"].pop()
+
+
+def instrument_s3(s3_client) -> None:
+    """Time every API call of the (aio)boto3 client."""
+
+    def _before_call(model, context, **kwargs):
+        context["call_start"] = time.perf_counter()
+
+    def _after_call(model, context, **kwargs):
+        if "call_start" in context:
+            S3_SECONDS.labels(model.name).observe(
+                time.perf_counter() - context["call_start"]
+            )
+
+    s3_client.meta.events.register("before-call.s3", _before_call)
+    s3_client.meta.events.register("after-call.s3", _after_call)
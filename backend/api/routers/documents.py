@@ -1,6 +1,9 @@
+from datetime import timedelta
+from typing import Optional
 from uuid import uuid4
 
-from fastapi import APIRouter, Depends, Response, UploadFile, File, Request
+from fastapi import APIRouter, Depends, Response, UploadFile, File, Form, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from celery import Celery
 from celery.result import AsyncResult
@@ -8,11 +11,22 @@ import sqlalchemy as sa
 
 from domain.auth.model import BaseUser, RoleEnum
 from domain.exceptions import BaseAPIException
-from infrastructure.postgres.models.document import DocumentDAO
+from infrastructure.postgres.models.document import DocumentDAO, DocumentProfileDAO
 from infrastructure.postgres.models.user import DocumentUserDAO
+from infrastructure.redis.database import state_redis
 from api.dependencies import get_current_user
+from api.metrics import UPLOAD_BYTES
 import settings
-from api.utils import process_file
+from api.utils import (
+    FILE_TASKS,
+    count_pages,
+    presigned_upload_url,
+    process_file,
+    read_header,
+    sniff_file_type,
+    stream_to_s3,
+    task_queue,
+)
 
 
 router = APIRouter(prefix="/documents", tags=["Documents"])
@@ -20,6 +34,31 @@ router = APIRouter(prefix="/documents", tags=["Documents"])
 celery = Celery(__name__)
 celery.conf.broker_url = settings.rabbitmq_settings.URI
 
+DECODE_TYPES = ("md", "latex")
+REDUCE_MODES = ("llm", "local", "auto")
+PROGRESS_FIELDS = (
+    "pages_total",
+    "pages_rasterized",
+    "pages_mapped",
+    "reduce_started",
+    "eta",
+)
+# summarized by /profiles/summary
+PROFILE_SUMMARY_FIELDS = (
+    "pages_count",
+    "total_secs",
+    "rasterize_secs",
+    "map_secs",
+    "map_latency_p50",
+    "map_latency_p95",
+    "reduce_secs",
+    "map_retries",
+    "prompt_tokens",
+    "completion_tokens",
+    "bytes_uploaded",
+)
+PROFILE_QUANTILES = (0.5, 0.9, 0.99)
+
 
 @router.get("/")
 async def get_all_docs(
@@ -61,34 +100,92 @@ async def get_all_docs(
 async def create_ocr_task(
     request: Request,
     document: UploadFile = File(),
+    decode_type: str = Form("md"),
+    reduce_mode: Optional[str] = Form(None),
     user: str = Depends(get_current_user),
 ):
     s3_session, pg_session = request.state.s3, request.state.db
 
-    doc_binary = document.file.read()
-    document.file.seek(0)
+    if decode_type not in DECODE_TYPES:
+        raise BaseAPIException(status_code=400, detail="Unsupported decode type")
+    if reduce_mode and reduce_mode not in REDUCE_MODES:
+        raise BaseAPIException(status_code=400, detail="Unsupported reduce mode")
 
-    _ = process_file(doc_binary)  # check if file is pdf
-    doc_s3_uuid = str(uuid4())
+    max_bytes = settings.app_settings.MAX_UPLOAD_BYTES
+    if document.size is not None and document.size > max_bytes:
+        raise BaseAPIException(status_code=413, detail="File is too large")
 
+    file_type = await sniff_file_type(document)  # check if file is supported
+
+    # the body goes to MinIO before the duplicate check, so that it is read
+    # only once
+    doc_s3_uuid = str(uuid4())
     try:
-        await s3_session.upload_fileobj(
-            document.file,
-            settings.minio_settings.BUCKET,
+        content_hash, size = await stream_to_s3(
+            s3_session,
+            document,
             doc_s3_uuid,
-            ExtraArgs={
-                "Metadata": {
-                    "ext": document.filename.split(".")[-1],
-                },
-            },
+            metadata={"ext": document.filename.split(".")[-1]},
+            max_bytes=max_bytes,
+            part_size=settings.app_settings.UPLOAD_PART_SIZE,
         )
-    except:
+    except BaseAPIException:
+        raise
+    except Exception:
         raise BaseAPIException(status_code=500, detail="S3 error")
 
+    UPLOAD_BYTES.labels(file_type).inc(size)
+    # pypdf reads the spooled file, keep it off the event loop
+    pages_count = await run_in_threadpool(count_pages, document, file_type)
+
+    # identical file has already been converted, share the result
+    q = (
+        sa.select(DocumentDAO)
+        .where(
+            DocumentDAO.content_hash == content_hash,
+            DocumentDAO.decode_type == decode_type,
+            DocumentDAO.s3_md_id.is_not(None),
+        )
+        .limit(1)
+    )
+    q = await pg_session.execute(q)
+    converted = q.scalar()
+
+    if converted:
+        try:
+            await s3_session.delete_object(
+                Bucket=settings.minio_settings.BUCKET, Key=doc_s3_uuid
+            )
+        except Exception as e:
+            print(f"Failed to delete duplicate upload {doc_s3_uuid}: {e}")
+
+        q = sa.select(DocumentUserDAO).where(
+            DocumentUserDAO.user_id == user,
+            DocumentUserDAO.document_id == converted.id,
+        )
+        q = await pg_session.execute(q)
+        if not q.scalar():
+            pg_doc_user = DocumentUserDAO(
+                user_id=user, document_id=converted.id, role=RoleEnum.viewer
+            )
+            pg_session.add(pg_doc_user)
+            await pg_session.commit()
+
+        return JSONResponse(
+            status_code=201,
+            content={
+                "msg": "The document has already been converted",
+                "doc_id": str(converted.id),
+            },
+        )
+
     pg_raw_document = DocumentDAO(
         id=doc_s3_uuid,
         name=".".join(document.filename.split(".")[:-1]),
         s3_raw_id=doc_s3_uuid,
+        content_hash=content_hash,
+        decode_type=decode_type,
+        pages_count=pages_count,
     )
     pg_session.add(pg_raw_document)
     await pg_session.commit()
@@ -99,7 +196,12 @@ async def create_ocr_task(
     pg_session.add(pg_doc_user)
     await pg_session.commit()
 
-    celery.send_task("images", task_id=doc_s3_uuid)
+    celery.send_task(
+        FILE_TASKS[file_type],
+        task_id=doc_s3_uuid,
+        kwargs={"decode_type": decode_type, "reduce_mode": reduce_mode},
+        queue=task_queue(file_type, pages_count),
+    )
 
     return JSONResponse(
         status_code=201,
@@ -110,6 +212,195 @@ async def create_ocr_task(
     )
 
 
+@router.post("/uploads")
+async def create_upload(
+    request: Request,
+    filename: str = Form(),
+    size: int = Form(),
+    decode_type: str = Form("md"),
+    user: str = Depends(get_current_user),
+):
+    """First step of a direct upload: a pending document and a presigned URL
+    to PUT the file to MinIO, then `POST /{document_id}/complete`.
+    """
+    _, pg_session = request.state.s3, request.state.db
+
+    if decode_type not in DECODE_TYPES:
+        raise BaseAPIException(status_code=400, detail="Unsupported decode type")
+    if size > settings.app_settings.MAX_UPLOAD_BYTES:
+        raise BaseAPIException(status_code=413, detail="File is too large")
+
+    doc_s3_uuid = str(uuid4())
+    headers = {"x-amz-meta-ext": filename.split(".")[-1]}
+    upload_url = await presigned_upload_url(
+        doc_s3_uuid, metadata={"ext": headers["x-amz-meta-ext"]}, size=size
+    )
+
+    # s3_raw_id is set once the upload is completed
+    pg_raw_document = DocumentDAO(
+        id=doc_s3_uuid,
+        name=".".join(filename.split(".")[:-1]),
+        decode_type=decode_type,
+    )
+    pg_session.add(pg_raw_document)
+    await pg_session.commit()
+
+    pg_doc_user = DocumentUserDAO(
+        user_id=user, document_id=doc_s3_uuid, role=RoleEnum.owner
+    )
+    pg_session.add(pg_doc_user)
+    await pg_session.commit()
+
+    return JSONResponse(
+        status_code=201,
+        content={
+            "doc_id": doc_s3_uuid,
+            "upload_url": upload_url,
+            "headers": headers,
+            "expires_in": settings.app_settings.UPLOAD_URL_TTL,
+        },
+    )
+
+
+@router.post("/{document_id}/complete")
+async def complete_upload(
+    request: Request,
+    document_id: str,
+    reduce_mode: Optional[str] = Form(None),
+    user: str = Depends(get_current_user),
+):
+    """Second step of a direct upload: check the stored file and start its
+    conversion.
+    """
+    s3_session, pg_session = request.state.s3, request.state.db
+
+    if reduce_mode and reduce_mode not in REDUCE_MODES:
+        raise BaseAPIException(status_code=400, detail="Unsupported reduce mode")
+
+    q = (
+        sa.select(DocumentDAO)
+        .join(DocumentUserDAO, DocumentUserDAO.document_id == DocumentDAO.id)
+        .where(
+            DocumentDAO.id == document_id,
+            DocumentUserDAO.user_id == user,
+            DocumentUserDAO.role == RoleEnum.owner,
+        )
+    )
+    q = await pg_session.execute(q)
+    document = q.scalar()
+
+    if document is None:
+        raise BaseAPIException(status_code=404, detail="Document not found")
+    if document.s3_raw_id:
+        raise BaseAPIException(status_code=409, detail="Upload already completed")
+
+    try:
+        head = await s3_session.head_object(
+            Bucket=settings.minio_settings.BUCKET, Key=document_id
+        )
+        header = await read_header(s3_session, document_id)
+    except Exception:
+        raise BaseAPIException(status_code=400, detail="File has not been uploaded")
+
+    try:
+        file_type = process_file(header)  # check if file is supported
+    except BaseAPIException:
+        await s3_session.delete_object(
+            Bucket=settings.minio_settings.BUCKET, Key=document_id
+        )
+        raise
+
+    size = head["ContentLength"]
+
+    # a concurrent call may have completed the upload in the meantime
+    q = (
+        sa.update(DocumentDAO)
+        .where(DocumentDAO.id == document_id, DocumentDAO.s3_raw_id.is_(None))
+        .values(s3_raw_id=document_id)
+    )
+    q = await pg_session.execute(q)
+    await pg_session.commit()
+    if q.rowcount != 1:
+        raise BaseAPIException(status_code=409, detail="Upload already completed")
+
+    UPLOAD_BYTES.labels(file_type).inc(size)
+    celery.send_task(
+        FILE_TASKS[file_type],
+        task_id=document_id,
+        kwargs={"decode_type": document.decode_type, "reduce_mode": reduce_mode},
+        queue=task_queue(file_type, None, size),
+    )
+
+    return JSONResponse(
+        status_code=201,
+        content={
+            "msg": "The task has been created successfully",
+            "doc_id": document_id,
+        },
+    )
+
+
+@router.get("/profiles/summary")
+async def get_profiles_summary(
+    request: Request,
+    hours: int = 24,
+    user: BaseUser = Depends(get_current_user),
+):
+    """Percentiles of the profiles of the documents converted in the last
+    `hours`.
+    """
+    _, pg_session = request.state.s3, request.state.db
+
+    columns = [sa.func.count().label("documents")]
+    for field in PROFILE_SUMMARY_FIELDS:
+        column = getattr(DocumentProfileDAO, field)
+        columns += [
+            sa.func.percentile_cont(quantile)
+            .within_group(column)
+            .label(f"{field}_p{int(quantile * 100)}")
+            for quantile in PROFILE_QUANTILES
+        ]
+
+    q = sa.select(*columns).where(
+        DocumentProfileDAO.finished_at >= sa.func.now() - timedelta(hours=hours)
+    )
+    q = await pg_session.execute(q)
+    row = q.mappings().one()
+
+    summary = {"documents": row["documents"], "hours": hours}
+    for field in PROFILE_SUMMARY_FIELDS:
+        summary[field] = {
+            f"p{int(quantile * 100)}": row[f"{field}_p{int(quantile * 100)}"]
+            for quantile in PROFILE_QUANTILES
+        }
+
+    return summary
+
+
+@router.get("/{document_id}/profile")
+async def get_document_profile(
+    request: Request,
+    document_id: str,
+    user: BaseUser = Depends(get_current_user),
+):
+    """Where the time of the last conversion of the document went."""
+    _, pg_session = request.state.s3, request.state.db
+
+    q = sa.select(DocumentProfileDAO).where(
+        DocumentProfileDAO.document_id == document_id
+    )
+    q = await pg_session.execute(q)
+    profile = q.scalar()
+
+    if profile is None:
+        raise BaseAPIException(status_code=404, detail="Profile is not available")
+
+    return {
+        column.name: getattr(profile, column.name)
+        for column in DocumentProfileDAO.__table__.columns
+    }
+
+
 @router.get("/{document_id}/status")
 async def check_doc_status(
     request: Request,
@@ -125,7 +416,28 @@ async def check_doc_status(
     if res.s3_md_id:
         return {"s3_md_id": res.s3_md_id}
 
-    return {"s3_md_id": "0"}
+    # published by the worker, empty until the task is picked up
+    fields = await state_redis.hmget(f"progress:{document_id}", PROGRESS_FIELDS)
+    if not any(fields):
+        return {"s3_md_id": "0", "progress": None}
+
+    progress = {k: int(v) if v else None for k, v in zip(PROGRESS_FIELDS, fields)}
+    progress["reduce_started"] = bool(progress["reduce_started"])
+
+    return {"s3_md_id": "0", "progress": progress}
+
+
+@router.get("/{document_id}/preview")
+async def get_document_preview(
+    document_id: str,
+    user: BaseUser = Depends(get_current_user),
+):
+    """Part of the document the worker has produced so far."""
+    content = await state_redis.get(f"reduce_preview:{document_id}")
+    if content is None:
+        raise BaseAPIException(status_code=404, detail="Preview is not available")
+
+    return {"content": content.decode("utf-8")}
 
 
 @router.get("/{document_id}")
@@ -1,11 +1,25 @@
+import hashlib
+from typing import Optional, Tuple
+
+import aioboto3
 import magic
+from botocore.config import Config
+from fastapi import UploadFile
+from pypdf import PdfReader
 
 from domain.exceptions import BaseAPIException
+import settings
+
+
+# worker task converting each supported file type
+FILE_TASKS = {"pdf": "images", "txt": "texts"}
+# head of the file passed to libmagic
+SNIFF_BYTES = 8 * 1024
 
 
 def process_file(byte_data):
     file_type = detect_file_type(byte_data)
-    if file_type == "unknown" or file_type != "pdf":
+    if file_type not in FILE_TASKS:
         raise BaseAPIException(status_code=400, detail="Unsupported format")
 
     return file_type
@@ -15,5 +29,158 @@ def detect_file_type(byte_data):
     mime = magic.Magic(mime=True)
     mime_types = {
         "application/pdf": "pdf",
+        "text/plain": "txt",
+        "text/markdown": "txt",
+        "text/x-tex": "txt",
     }
     return mime_types.get(mime.from_buffer(byte_data), "unknown")
+
+
+async def sniff_file_type(upload: UploadFile) -> str:
+    """Supported file type detected from the head of the upload only."""
+    header = await upload.read(SNIFF_BYTES)
+    await upload.seek(0)
+
+    return process_file(header)
+
+
+async def stream_to_s3(
+    s3_client,
+    upload: UploadFile,
+    key: str,
+    metadata: dict,
+    max_bytes: int,
+    part_size: int,
+) -> Tuple[str, int]:
+    """Copy the upload to MinIO part by part, hashing it on the way.
+
+    At most two parts are held in memory whatever the file size. Files of a
+    single part are stored with one `put_object`. Past `max_bytes` the
+    upload is aborted with 413.
+
+    :return: SHA-256 and size of the file.
+    """
+    bucket = settings.minio_settings.BUCKET
+    content_hash = hashlib.sha256()
+    size, upload_id, parts = 0, None, []
+
+    try:
+        chunk = await upload.read(part_size)
+        while True:
+            size += len(chunk)
+            if size > max_bytes:
+                raise BaseAPIException(status_code=413, detail="File is too large")
+            content_hash.update(chunk)
+
+            next_chunk = await upload.read(part_size) if chunk else b""
+            if upload_id is None and not next_chunk:
+                await s3_client.put_object(
+                    Bucket=bucket, Key=key, Body=chunk, Metadata=metadata
+                )
+                break
+
+            if upload_id is None:
+                response = await s3_client.create_multipart_upload(
+                    Bucket=bucket, Key=key, Metadata=metadata
+                )
+                upload_id = response["UploadId"]
+            response = await s3_client.upload_part(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=len(parts) + 1,
+                Body=chunk,
+            )
+            parts.append({"ETag": response["ETag"], "PartNumber": len(parts) + 1})
+
+            if not next_chunk:
+                await s3_client.complete_multipart_upload(
+                    Bucket=bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+                break
+            chunk = next_chunk
+    except Exception:
+        if upload_id is not None:
+            try:
+                await s3_client.abort_multipart_upload(
+                    Bucket=bucket, Key=key, UploadId=upload_id
+                )
+            except Exception as e:
+                print(f"Failed to abort upload of {key}: {e}")
+        raise
+
+    return content_hash.hexdigest(), size
+
+
+def count_pages(upload: UploadFile, file_type: str) -> Optional[int]:
+    """Page count from the PDF page tree, the pages themselves are not parsed.
+
+    :return: None for other file types and PDFs which can not be read.
+    """
+    if file_type != "pdf":
+        return None
+
+    try:
+        return len(PdfReader(upload.file).pages)
+    except Exception as e:
+        print(f"Failed to count pages: {e}")
+        return None
+    finally:
+        upload.file.seek(0)
+
+
+def task_queue(
+    file_type: str, pages_count: Optional[int], size: Optional[int] = None
+) -> str:
+    """Worker queue of the task, large documents do not hold up small ones.
+
+    Without a page count the file size decides, if known.
+    """
+    if file_type != "pdf":
+        return "celery"
+    if pages_count is None:
+        if size is not None and size <= settings.app_settings.LARGE_DOC_BYTES:
+            return "images.small"
+        return "images.large"
+    if pages_count > settings.app_settings.LARGE_DOC_PAGES:
+        return "images.large"
+    return "images.small"
+
+
+async def presigned_upload_url(key: str, metadata: dict, size: int) -> str:
+    """URL to PUT the file straight to MinIO.
+
+    Size and metadata are signed, the client has to send exactly `size`
+    bytes and the `x-amz-meta-*` headers of `metadata`.
+    """
+    async with aioboto3.Session().client(
+        "s3",
+        endpoint_url=settings.minio_settings.PUBLIC_URI or settings.minio_settings.URI,
+        aws_access_key_id=settings.minio_settings.ROOT_USER,
+        aws_secret_access_key=settings.minio_settings.ROOT_PASSWORD,
+        config=Config(signature_version="s3v4"),
+    ) as s3_client:
+        return await s3_client.generate_presigned_url(
+            "put_object",
+            Params={
+                "Bucket": settings.minio_settings.BUCKET,
+                "Key": key,
+                "Metadata": metadata,
+                "ContentLength": size,
+            },
+            ExpiresIn=settings.app_settings.UPLOAD_URL_TTL,
+        )
+
+
+async def read_header(s3_client, key: str) -> bytes:
+    """First `SNIFF_BYTES` of a stored file."""
+    response = await s3_client.get_object(
+        Bucket=settings.minio_settings.BUCKET,
+        Key=key,
+        Range=f"bytes=0-{SNIFF_BYTES - 1}",
+    )
+    async with response["Body"] as stream:
+        return await stream.read()
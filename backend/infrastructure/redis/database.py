@@ -0,0 +1,7 @@
+from redis import asyncio as aioredis
+
+from settings import redis_settings
+
+
+# worker state (task progress, partial results), shared with neural_worker
+state_redis = aioredis.Redis.from_url(redis_settings.STATE_URI)
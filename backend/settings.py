@@ -17,6 +17,19 @@ class AppSettings(BaseSettings):
     HC_TIMEOUT: int = 30  # secs
     HC_SLEEP: int = 5  # secs
 
+    # PDFs with more pages go to the "images.large" worker queue
+    LARGE_DOC_PAGES: int = 32
+    # same for PDFs uploaded straight to MinIO, whose pages are not counted
+    LARGE_DOC_BYTES: int = 16 * 1024 * 1024
+
+    MAX_UPLOAD_BYTES: int = 200 * 1024 * 1024
+    # room for the form fields and boundaries around the file in the body
+    MAX_FORM_OVERHEAD: int = 64 * 1024
+    # uploads are streamed to MinIO in parts of this size, S3 does not
+    # accept parts smaller than 5 MiB
+    UPLOAD_PART_SIZE: int = 8 * 1024 * 1024
+    UPLOAD_URL_TTL: int = 3600  # secs, presigned upload URLs
+
     class Config(ToolConfig):
         env_prefix = "api_"
 
@@ -25,12 +38,18 @@ class RedisSettings(BaseSettings):
     HOST: str = "redis"
     PORT: int = 6379
     BACKEND_DB: int = 0
+    STATE_DB: int = 2
 
     @computed_field(return_type=str)
     @property
     def URI(self):
         return f"redis://{self.HOST}:{self.PORT}/{self.BACKEND_DB}"
 
+    @computed_field(return_type=str)
+    @property
+    def STATE_URI(self):
+        return f"redis://{self.HOST}:{self.PORT}/{self.STATE_DB}"
+
     class Config(ToolConfig):
         env_prefix = "redis_"
 
@@ -56,6 +75,8 @@ class MinIOSettings(BaseSettings):
     API_PORT: int = 9000
     ROOT_USER: str = "admin"
     ROOT_PASSWORD: str = "admin_password"
+    # MinIO as reachable by the clients, used in presigned URLs
+    PUBLIC_URI: str = ""
 
     @computed_field(return_type=str)
     @property
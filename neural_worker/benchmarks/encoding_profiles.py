@@ -0,0 +1,76 @@
+"""Payload size and encode time of every page encoding profile.
+
+Usage (from the neural_worker directory):
+
+    python -m benchmarks.encoding_profiles doc.pdf [doc2.pdf ...] [--json]
+"""
+import argparse
+import json
+import statistics
+import time
+
+from pdf2image import convert_from_path
+
+from encoding import ENCODING_PROFILES, encode_page
+
+
+def benchmark_profile(pdf_paths, profile, max_pages=None):
+    page_bytes, render_secs, encode_secs = [], [], []
+
+    for pdf_path in pdf_paths:
+        start = time.perf_counter()
+        pdf_imgs = convert_from_path(
+            pdf_path,
+            dpi=profile.dpi,
+            grayscale=profile.grayscale,
+            last_page=max_pages,
+        )
+        render_secs.append((time.perf_counter() - start) / max(len(pdf_imgs), 1))
+
+        for img in pdf_imgs:
+            start = time.perf_counter()
+            page = encode_page(img, profile)
+            encode_secs.append(time.perf_counter() - start)
+            page_bytes.append(len(page))
+            img.close()
+
+    return {
+        "pages": len(page_bytes),
+        "bytes_per_page": statistics.mean(page_bytes),
+        "max_bytes_per_page": max(page_bytes),
+        "render_ms_per_page": 1000 * statistics.mean(render_secs),
+        "encode_ms_per_page": 1000 * statistics.mean(encode_secs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("pdf", nargs="+", help="PDF files to rasterize")
+    parser.add_argument("--profiles", nargs="*", default=list(ENCODING_PROFILES))
+    parser.add_argument("--max-pages", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    args = parser.parse_args()
+
+    results = {
+        name: benchmark_profile(args.pdf, ENCODING_PROFILES[name], args.max_pages)
+        for name in args.profiles
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"{'profile':<10} {'pages':>6} {'KiB/page':>10} {'max KiB':>9} "
+        f"{'render ms':>10} {'encode ms':>10}"
+    )
+    for name, res in results.items():
+        print(
+            f"{name:<10} {res['pages']:>6} {res['bytes_per_page'] / 1024:>10.1f} "
+            f"{res['max_bytes_per_page'] / 1024:>9.1f} "
+            f"{res['render_ms_per_page']:>10.1f} {res['encode_ms_per_page']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""OpenAI-compatible chat completions stand-in for offline benchmarks.
+
+Usage (from the neural_worker directory):
+
+    python -m benchmarks.fake_openai [--port 8765] [--latency-ms 800] ...
+
+then point the worker at it with NW_BASE_OPENAI_URL=http://127.0.0.1:8765/v1.
+Answers every request with generated markdown after a log-normally
+distributed delay, fails a share of requests with 500 or 429, and streams
+the answer as server-sent events when asked to.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# pages listed by the packed map prompt, see config.DEFAULT_PACKED_MAP_PROMPT
+PACKED_PAGES_RE = re.compile(r"are the pages ([\d, ]+) of the document")
+PAGE_MARKER = "===PAGE {}==="
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do".split()
+
+
+@dataclass
+class FakeOpenAIConfig:
+    latency_ms: float = 800.0  # median response time
+    latency_sigma: float = 0.5  # of the log-normal distribution
+    error_rate: float = 0.0  # share of 500 responses
+    rate_limit_rate: float = 0.0  # share of 429 responses
+    output_tokens: int = 400  # per page of the answer
+    stream_chunk_tokens: int = 8
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeOpenAI/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def config(self) -> FakeOpenAIConfig:
+        return self.server.config
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(
+            self.config.latency_ms
+            / 1000
+            * random.lognormvariate(0, self.config.latency_sigma)
+        )
+
+        chance = random.random()
+        if chance < self.config.rate_limit_rate:
+            return self._send_error(429, "rate_limit_exceeded", retry_after=1)
+        if chance < self.config.rate_limit_rate + self.config.error_rate:
+            return self._send_error(500, "server_error")
+
+        with self.server.lock:
+            self.server.requests += 1
+
+        content = self._answer(body)
+        if body.get("stream"):
+            return self._send_stream(body["model"], content)
+
+        completion_tokens = len(content) // 4
+        self._send_json(
+            200,
+            {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": content},
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 1000,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": 1000 + completion_tokens,
+                },
+            },
+        )
+
+    def _answer(self, body: dict) -> str:
+        content = body["messages"][0]["content"]
+        prompt = content if isinstance(content, str) else content[0]["text"]
+        match = PACKED_PAGES_RE.search(prompt)
+
+        if match:
+            pages = [int(page) for page in match.group(1).split(", ")]
+            text = "\n".join(
+                f"{PAGE_MARKER.format(page)}\n{self._page_text()}" for page in pages
+            )
+        else:
+            text = self._page_text()
+        return f"```md\n{text}\n```"
+
+    def _page_text(self) -> str:
+        words = random.choices(WORDS, k=self.config.output_tokens)
+        lines = [" ".join(words[i : i + 12]) for i in range(0, len(words), 12)]
+        return "# Page\n\n" + "\n".join(lines)
+
+    def _send_stream(self, model: str, content: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        step = 4 * self.config.stream_chunk_tokens
+        for i in range(0, len(content), step):
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": content[i : i + step]},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def _send_error(self, status: int, code: str, retry_after: int = None):
+        headers = {"Retry-After": str(retry_after)} if retry_after else {}
+        self._send_json(
+            status, {"error": {"message": code, "type": code, "code": code}}, headers
+        )
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(host: str, port: int, config: FakeOpenAIConfig) -> ThreadingHTTPServer:
+    """Start the server in a daemon thread, port 0 picks a free one.
+
+    :return: running server, its `requests` counts the successful ones.
+    """
+    server = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.requests = 0
+    server.lock = threading.Lock()
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_config_args(parser: argparse.ArgumentParser) -> None:
+    defaults = FakeOpenAIConfig()
+    parser.add_argument("--latency-ms", type=float, default=defaults.latency_ms)
+    parser.add_argument("--latency-sigma", type=float, default=defaults.latency_sigma)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument(
+        "--rate-limit-rate", type=float, default=defaults.rate_limit_rate
+    )
+    parser.add_argument("--output-tokens", type=int, default=defaults.output_tokens)
+
+
+def config_from_args(args: argparse.Namespace) -> FakeOpenAIConfig:
+    return FakeOpenAIConfig(
+        latency_ms=args.latency_ms,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        output_tokens=args.output_tokens,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_config_args(parser)
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, config_from_args(args))
+    print(f"Serving on http://{args.host}:{server.server_port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""Stage by stage timings of `process_file` on synthetic PDFs.
+
+Usage (from the neural_worker directory):
+
+    python -m benchmarks.rasterization [--pages 1 10 50] [--json]
+    python -m benchmarks.rasterization --save baseline.json
+    python -m benchmarks.rasterization --baseline baseline.json [--tolerance 0.2]
+
+Every document of the page counts x density x kind matrix is timed per
+stage: pdfinfo, text layer extraction, rendering (pdftoppm vs pdftocairo,
+DPI, `thread_count`), blank detection, image encoding per format, base64,
+and `process_file` as a whole per number of rasterizer processes. With
+`--baseline` cases slower than the baseline by more than `--tolerance` are
+reported and the exit code is 1.
+"""
+import argparse
+import base64
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from io import BytesIO
+from tempfile import NamedTemporaryFile
+
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image, ImageDraw
+
+import settings
+from encoding import get_profile
+from resources import resources
+from utils import _text_layer_pages, is_blank_page, process_file
+
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do".split()
+DENSITIES = {"sparse": 8, "dense": 50}  # text lines per page
+FORMATS = ("JPEG", "PNG", "WEBP")
+
+
+def make_scanned_pdf(pages: int, lines: int, seed: int = 0) -> bytes:
+    """Image-only PDF of A4 pages at 150 dpi, like a scan."""
+    rng = random.Random(seed)
+    imgs = []
+    for _ in range(pages):
+        img = Image.new("L", (1240, 1754), 255)
+        draw = ImageDraw.Draw(img)
+        step = 1450 // lines
+        for y in range(150, 150 + lines * step, step):
+            draw.text((120, y), " ".join(rng.choices(WORDS, k=14)), fill=0)
+        imgs.append(img)
+
+    buffered = BytesIO()
+    imgs[0].save(
+        buffered, "PDF", save_all=True, append_images=imgs[1:], resolution=150
+    )
+    return buffered.getvalue()
+
+
+def make_digital_pdf(pages: int, lines: int, seed: int = 0) -> bytes:
+    """Born-digital PDF with a Helvetica text layer on every page."""
+    rng = random.Random(seed)
+    page_ids = [4 + 2 * i for i in range(pages)]
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [%s] /Count %d >>"
+        % (b" ".join(b"%d 0 R" % i for i in page_ids), pages),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for page_id in page_ids:
+        text_lines = [" ".join(rng.choices(WORDS, k=12)) for _ in range(lines)]
+        stream = b"BT /F1 11 Tf 14 TL 72 770 Td " + b" ".join(
+            b"(%s) Tj T*" % line.encode() for line in text_lines
+        ) + b" ET"
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % (page_id + 1)
+        )
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for num, obj in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (num, obj)
+
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    return bytes(pdf)
+
+
+def timed(func, repeat: int):
+    """:return: last result of `func` and the median of its run times (secs)."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, statistics.median(times)
+
+
+def benchmark_document(pdf_path: str, pdf_data: bytes, pages: int, args) -> dict:
+    results = {}
+
+    def per_page(secs: float) -> dict:
+        return {"ms_per_page": 1000 * secs / pages}
+
+    _, secs = timed(lambda: pdfinfo_from_path(pdf_path), args.repeat)
+    results["pdfinfo"] = per_page(secs)
+
+    _, secs = timed(
+        lambda: _text_layer_pages(pdf_path, list(range(pages))), args.repeat
+    )
+    results["text_layer"] = per_page(secs)
+
+    imgs = None
+    for renderer in args.renderers:
+        for dpi in args.dpi:
+            for threads in args.threads:
+                rendered, secs = timed(
+                    lambda: convert_from_path(
+                        pdf_path,
+                        dpi=dpi,
+                        thread_count=threads,
+                        use_pdftocairo=renderer == "pdftocairo",
+                    ),
+                    args.repeat,
+                )
+                results[f"render/{renderer}/dpi{dpi}/t{threads}"] = per_page(secs)
+                if imgs is None:
+                    imgs = rendered
+                else:
+                    for img in rendered:
+                        img.close()
+
+    _, secs = timed(lambda: [is_blank_page(img) for img in imgs], args.repeat)
+    results["blank_detection"] = per_page(secs)
+
+    for fmt in args.formats:
+
+        def _save():
+            encoded = []
+            for img in imgs:
+                buffered = BytesIO()
+                if fmt == "PNG":
+                    img.save(buffered, format=fmt, optimize=True)
+                else:
+                    img.save(buffered, format=fmt, quality=75)
+                encoded.append(buffered.getvalue())
+            return encoded
+
+        encoded, secs = timed(_save, args.repeat)
+        results[f"encode/{fmt}"] = {
+            **per_page(secs),
+            "bytes_per_page": sum(map(len, encoded)) / pages,
+        }
+
+        _, secs = timed(
+            lambda: [base64.b64encode(data).decode() for data in encoded],
+            args.repeat,
+        )
+        results[f"base64/{fmt}"] = per_page(secs)
+
+    for img in imgs:
+        img.close()
+
+    profile = get_profile(settings.app_settings.ENCODING_PROFILE)
+    for processes in args.processes:
+        settings.app_settings.RASTER_PROCESSES = processes
+        resources.close_raster_pool()
+        _, secs = timed(
+            lambda: list(process_file(pdf_data, "pdf", profile=profile)[1]),
+            args.repeat,
+        )
+        results[f"process_file/p{processes}"] = per_page(secs)
+    resources.close_raster_pool()
+
+    return results
+
+
+def run_suite(args) -> dict:
+    makers = {"scanned": make_scanned_pdf, "digital": make_digital_pdf}
+    results = {}
+
+    for kind in args.kinds:
+        for density in args.densities:
+            for pages in args.pages:
+                pdf_data = makers[kind](pages, DENSITIES[density])
+                with NamedTemporaryFile(suffix=".pdf") as pdf_file:
+                    pdf_file.write(pdf_data)
+                    pdf_file.flush()
+                    doc_results = benchmark_document(
+                        pdf_file.name, pdf_data, pages, args
+                    )
+
+                for stage, metrics in doc_results.items():
+                    results[f"{kind}/{density}/{pages}p/{stage}"] = metrics
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """:return: (case, metric, baseline, current) of every regression."""
+    regressions = []
+    for case, metrics in results["results"].items():
+        base_metrics = baseline["results"].get(case)
+        if base_metrics is None:
+            continue
+        for metric, value in metrics.items():
+            base_value = base_metrics.get(metric)
+            if base_value and value > base_value * (1 + tolerance):
+                regressions.append((case, metric, base_value, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--kinds", nargs="+", default=["scanned", "digital"])
+    parser.add_argument("--densities", nargs="+", default=list(DENSITIES))
+    parser.add_argument(
+        "--renderers", nargs="+", default=["pdftoppm", "pdftocairo"]
+    )
+    parser.add_argument("--dpi", type=int, nargs="+", default=[200, 150, 300])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--formats", nargs="+", default=list(FORMATS))
+    parser.add_argument(
+        "--processes", type=int, nargs="+", default=[1, 2, 4], help="rasterizers"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    args = parser.parse_args()
+
+    results = run_suite(args)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'case':<48} {'ms/page':>9} {'KiB/page':>9}")
+        for case, metrics in results["results"].items():
+            kib = metrics.get("bytes_per_page")
+            print(
+                f"{case:<48} {metrics['ms_per_page']:>9.2f} "
+                f"{kib / 1024 if kib else float('nan'):>9.1f}"
+            )
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for case, metric, base_value, value in regressions:
+            print(
+                f"REGRESSION {case} {metric}: {base_value:.2f} -> {value:.2f}",
+                file=sys.stderr,
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
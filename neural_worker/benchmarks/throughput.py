@@ -0,0 +1,253 @@
+"""End-to-end throughput of the images task against local stand-ins.
+
+Usage (from the neural_worker directory):
+
+    python -m benchmarks.throughput [--docs 20] [--pages 10] [--processes 2] [--json]
+
+Synthetic scanned PDFs go through `process_images` with the model replaced
+by `benchmarks.fake_openai`, MinIO by an in-memory store and Postgres by
+SQLite, so the numbers measure the worker itself: rasterization, encoding,
+scheduling and Redis round-trips. Needs poppler and a Redis server reachable
+with the REDIS_* settings (rate limiter, checkpoints, progress).
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from multiprocessing import get_context
+from uuid import uuid4
+
+from PIL import Image, ImageDraw
+
+from benchmarks.fake_openai import WORDS, add_config_args, config_from_args, serve
+
+
+class MemoryS3:
+    """In-memory stand-in for the boto3 S3 client calls of the worker."""
+
+    def __init__(self) -> None:
+        self.objects = {}
+        self.uploads = {}
+
+    def head_bucket(self, Bucket):
+        return {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = (bytes(Body), kwargs.get("Metadata", {}))
+
+    def get_object(self, Bucket, Key):
+        data, metadata = self.objects[Key]
+        return {"Body": BytesIO(data), "Metadata": metadata}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid4().hex
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = Body
+        return {"ETag": str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        data = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+        self.objects[Key] = (data, {})
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        keys = [key for key in list(self.objects) if key.startswith(Prefix)]
+        yield {"Contents": [{"Key": key} for key in keys]}
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete["Objects"]:
+            self.objects.pop(obj["Key"], None)
+
+    def close(self):
+        pass
+
+
+class ThreadSampler(threading.Thread):
+    """Peak number of threads of the process, sampled every `interval` secs."""
+
+    def __init__(self, interval: float = 0.05) -> None:
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count() - 1)
+
+    def stop(self) -> int:
+        self._stop_event.set()
+        self.join()
+        return self.peak
+
+
+def make_pdf(pages: int, seed: int) -> bytes:
+    """Scanned-like PDF (no text layer) of A4 pages at 150 dpi."""
+    rng = random.Random(seed)
+    imgs = []
+    for _ in range(pages):
+        img = Image.new("L", (1240, 1754), 255)
+        draw = ImageDraw.Draw(img)
+        for y in range(150, 1600, 30):
+            draw.text((120, y), " ".join(rng.choices(WORDS, k=14)), fill=0)
+        imgs.append(img)
+
+    buffered = BytesIO()
+    imgs[0].save(
+        buffered, "PDF", save_all=True, append_images=imgs[1:], resolution=150
+    )
+    return buffered.getvalue()
+
+
+def run_worker(docs, task_kwargs: dict) -> dict:
+    """Run the documents one by one, like a single prefork process does."""
+    # worker modules read the settings prepared by `main` at import time
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import StaticPool
+
+    import settings
+    from celery_services import celery, process_images
+    from infrastructure.postgres import database
+    from resources import resources
+
+    sqlite_engine = create_engine(
+        "sqlite://",
+        poolclass=StaticPool,
+        connect_args={"check_same_thread": False},
+    )
+    database.Base.metadata.create_all(sqlite_engine)
+    database.session_factory.configure(bind=sqlite_engine)
+
+    s3_client = resources._s3_client = MemoryS3()
+    celery.conf.task_always_eager = True
+
+    sampler = ThreadSampler()
+    sampler.start()
+
+    latencies, failed = [], 0
+    for pdf in docs:
+        doc_id = str(uuid4())
+        s3_client.put_object(
+            Bucket=settings.minio_settings.BUCKET,
+            Key=doc_id,
+            Body=pdf,
+            Metadata={"ext": "pdf"},
+        )
+
+        start = time.perf_counter()
+        result = process_images.apply(kwargs=task_kwargs, task_id=doc_id)
+        latencies.append(time.perf_counter() - start)
+        if result.failed():
+            failed += 1
+            print(f"Task {doc_id} failed: {result.result!r}")
+
+    return {
+        "latencies": latencies,
+        "failed": failed,
+        "peak_threads": sampler.stop(),
+        # KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    server = serve("127.0.0.1", 0, config_from_args(args))
+    os.environ.update(
+        {
+            "NW_BASE_OPENAI_URL": f"http://127.0.0.1:{server.server_port}/v1",
+            "NW_OPENAI_KEY": "fake",
+            "NW_RATE_LIMIT_RPM": "0",
+            "NW_RATE_LIMIT_TPM": "0",
+            "NW_CACHE_ENABLED": str(args.cache).lower(),
+        }
+    )
+
+    pdfs = [make_pdf(args.pages, seed) for seed in range(args.docs)]
+    task_kwargs = {"decode_type": "md", "reduce_mode": args.reduce_mode}
+    if args.pages_per_request:
+        task_kwargs["pages_per_request"] = args.pages_per_request
+    if args.encoding_profile:
+        task_kwargs["encoding_profile"] = args.encoding_profile
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.processes, mp_context=get_context("fork")) as pool:
+        workers = list(
+            pool.map(
+                run_worker,
+                [pdfs[i :: args.processes] for i in range(args.processes)],
+                [task_kwargs] * args.processes,
+            )
+        )
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    latencies = [latency for worker in workers for latency in worker["latencies"]]
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else []
+    return {
+        "docs": args.docs,
+        "pages": args.docs * args.pages,
+        "processes": args.processes,
+        "failed": sum(worker["failed"] for worker in workers),
+        "llm_requests": server.requests,
+        "elapsed_s": elapsed,
+        "pages_per_s": args.docs * args.pages / elapsed,
+        "p50_s": quantiles[49] if quantiles else latencies[0],
+        "p95_s": quantiles[94] if quantiles else latencies[0],
+        "p99_s": quantiles[98] if quantiles else latencies[0],
+        "peak_rss_mb": max(worker["peak_rss_mb"] for worker in workers),
+        "peak_threads": max(worker["peak_threads"] for worker in workers),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=10, help="pages per document")
+    parser.add_argument("--processes", type=int, default=2, help="worker processes")
+    parser.add_argument("--reduce-mode", default="local")
+    parser.add_argument("--pages-per-request", type=int, default=None)
+    parser.add_argument("--encoding-profile", default=None)
+    parser.add_argument("--cache", action="store_true", help="keep the page cache")
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    add_config_args(parser)
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"{results['docs']} docs / {results['pages']} pages in "
+        f"{results['elapsed_s']:.1f} s on {results['processes']} processes, "
+        f"{results['failed']} failed, {results['llm_requests']} LLM requests"
+    )
+    print(f"throughput   {results['pages_per_s']:.2f} pages/s")
+    print(
+        f"task latency p50 {results['p50_s']:.2f} s, "
+        f"p95 {results['p95_s']:.2f} s, p99 {results['p99_s']:.2f} s"
+    )
+    print(
+        f"peak RSS     {results['peak_rss_mb']:.0f} MiB, "
+        f"{results['peak_threads']} threads"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import hashlib
+import time
+from typing import Optional
+
+from botocore.exceptions import ClientError
+from redis import asyncio as aioredis
+
+import settings
+from metrics import to_thread
+from rate_limiter import state_redis
+from resources import resources
+
+
+class PageCache:
+    """Content-addressed cache of map results.
+
+    Entries are keyed on the page content together with everything that
+    changes the model output (model, prompt template, decode type). Redis
+    keeps the hot entries with a TTL and a size bound enforced in LRU order;
+    with `s3_spill` every entry is also written to MinIO and evicted entries
+    are promoted back to Redis on their next hit.
+    """
+
+    prefix = "ocr_cache"
+
+    def __init__(
+        self,
+        redis_client: aioredis.Redis,
+        max_entries: int,
+        ttl: int,
+        s3_spill: bool = False,
+    ) -> None:
+        self.redis = redis_client
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.s3_spill = s3_spill
+
+        self.lru_key = f"{self.prefix}:lru"
+        self.stats_key = f"{self.prefix}:stats"
+
+    @staticmethod
+    def make_key(content: str, decode_type: str, prompt: str) -> str:
+        digest = hashlib.sha256()
+        for part in (settings.app_settings.MODEL_NAME, prompt, decode_type, content):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _entry_key(self, key: str) -> str:
+        return f"{self.prefix}:entry:{key}"
+
+    def _s3_key(self, key: str) -> str:
+        return f"{self.prefix}/{key}"
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            value = await self.redis.get(self._entry_key(key))
+            if value is not None:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    pipe.zadd(self.lru_key, {key: time.time()})
+                    pipe.expire(self._entry_key(key), self.ttl)
+                    pipe.hincrby(self.stats_key, "hits", 1)
+                    await pipe.execute()
+                return value.decode("utf-8")
+
+            if self.s3_spill:
+                value = await to_thread(self._s3_get, key)
+                if value is not None:
+                    await self._put_redis(key, value)
+                    await self.redis.hincrby(self.stats_key, "s3_hits", 1)
+                    return value
+
+            await self.redis.hincrby(self.stats_key, "misses", 1)
+        except Exception as e:
+            print(f"Cache read error: {e}")
+
+        return None
+
+    async def set(self, key: str, value: str) -> None:
+        try:
+            await self._put_redis(key, value)
+            if self.s3_spill:
+                await to_thread(self._s3_put, key, value)
+        except Exception as e:
+            print(f"Cache write error: {e}")
+
+    async def stats(self) -> dict:
+        counters = await self.redis.hgetall(self.stats_key)
+        stats = {"hits": 0, "s3_hits": 0, "misses": 0}
+        stats.update({k.decode(): int(v) for k, v in counters.items()})
+        stats["entries"] = await self.redis.zcard(self.lru_key)
+        return stats
+
+    async def _put_redis(self, key: str, value: str) -> None:
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(self._entry_key(key), value, ex=self.ttl)
+            pipe.zadd(self.lru_key, {key: now})
+            # entries which have already expired by TTL
+            pipe.zremrangebyscore(self.lru_key, "-inf", now - self.ttl)
+            pipe.zcard(self.lru_key)
+            *_, size = await pipe.execute()
+
+        if size > self.max_entries:
+            evicted = await self.redis.zpopmin(self.lru_key, size - self.max_entries)
+            if evicted:
+                await self.redis.delete(
+                    *(self._entry_key(k.decode()) for k, _ in evicted)
+                )
+
+    def _s3_get(self, key: str) -> Optional[str]:
+        try:
+            response = resources.s3_client.get_object(
+                Bucket=settings.minio_settings.BUCKET, Key=self._s3_key(key)
+            )
+        except ClientError:
+            return None
+        return response["Body"].read().decode("utf-8")
+
+    def _s3_put(self, key: str, value: str) -> None:
+        resources.s3_client.put_object(
+            Bucket=settings.minio_settings.BUCKET,
+            Key=self._s3_key(key),
+            Body=value.encode("utf-8"),
+            ContentType="text/markdown",
+        )
+
+
+page_cache = PageCache(
+    redis_client=state_redis,
+    max_entries=settings.app_settings.CACHE_MAX_ENTRIES,
+    ttl=settings.app_settings.CACHE_TTL,
+    s3_spill=settings.app_settings.CACHE_S3_SPILL,
+)
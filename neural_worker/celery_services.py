@@ -1,85 +1,632 @@
-import io
-from multiprocessing.pool import ThreadPool
-from typing import List
-from uuid import uuid4
-
-from celery import Celery
-from openai import OpenAI
-import boto3
+import asyncio
+import random
+import re
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from uuid import UUID, uuid4
+
+from celery import Celery, chord
 from sqlalchemy import update
 
 import config
 import settings
-from utils import process_file
-from infrastructure.postgres import database
+from cache import page_cache
+from checkpoints import Checkpoint, get_checkpoint
+from encoding import get_profile
+from merger import merge_pages
+from metrics import MAP_SECONDS, REDUCE_SECONDS, to_thread
+from ocr_engine import engine
+from profiling import DocumentProfile, current_page_tokens, current_profile
+from progress import ProgressReporter, get_progress
+from rate_limiter import state_redis
+from resources import resources
+from storage import FenceStripper, ResultWriter
+from utils import Page, estimate_tokens, process_file, split_text
 from infrastructure.postgres.models import DocumentDAO
 
 
 REPLACERS = {"latex": config.LATEX_REPLACER, "md": config.MD_REPLACER}
-
-
-client = OpenAI(
-    api_key=settings.app_settings.OPENAI_KEY,
-    base_url=settings.app_settings.BASE_OPENAI_URL,
+REDUCE_MODES = ("llm", "local", "auto")
+PAGE_MARKER_RE = re.compile(
+    "^" + re.escape(config.PAGE_MARKER).replace(r"\{\}", r"(\d+)") + r"\s*$", re.M
 )
 
+
 celery = Celery(__name__)
 celery.conf.broker_url = settings.rabbitmq_settings.URI
 celery.conf.result_backend = settings.redis_settings.URI
+# leaves time for the connection warm-up in resources.init_worker_process
+celery.conf.worker_proc_alive_timeout = 30
+# the backend sends images tasks to images.small or images.large by page
+# count, the fan-out of a large document stays on the large workers
+celery.conf.task_routes = {
+    "map_pages": {"queue": "images.large"},
+    "reduce_pages": {"queue": "images.large"},
+}
 
 
 @celery.task(
     name="images", bind=True, time_limit=600, soft_time_limit=540, track_started=True
 )
-def process_images(self, decode_type: str = "md"):
+def process_images(
+    self,
+    decode_type: str = "md",
+    reduce_mode: str = None,
+    encoding_profile: str = None,
+    pages_per_request: int = None,
+):
     task_id = self.request.id
+    reduce_mode = _get_reduce_mode(reduce_mode)
+    profile = get_profile(encoding_profile or settings.app_settings.ENCODING_PROFILE)
+    pages_per_request = pages_per_request or settings.app_settings.PAGES_PER_REQUEST
 
-    s3_client = boto3.client(
-        "s3",
-        endpoint_url=settings.minio_settings.URI,
-        aws_access_key_id=settings.minio_settings.ROOT_USER,
-        aws_secret_access_key=settings.minio_settings.ROOT_PASSWORD,
+    replacer = REPLACERS[decode_type]
+    checkpoint = get_checkpoint(task_id)
+    progress = get_progress(self)
+    pages_count, map_results = engine.run(checkpoint.load())
+    doc_profile = _resume_profile(self, checkpoint)
+
+    s3_client = resources.s3_client
+    page_refs = None
+
+    # resume from the checkpoint, rasterize and map only the missing pages
+    if pages_count is None or len(map_results) < pages_count:
+        response = s3_client.get_object(
+            Bucket=settings.minio_settings.BUCKET, Key=task_id
+        )
+        data = response["Body"].read()
+
+        try:
+            pages_count, imgs_binary = process_file(
+                data,
+                file_type=response["Metadata"]["ext"],
+                skip=map_results,
+                profile=profile,
+            )
+            engine.run(checkpoint.set_pages_count(pages_count))
+            engine.run(progress.start(pages_count, len(map_results)))
+
+            if pages_count - len(map_results) > settings.app_settings.FANOUT_MIN_PAGES:
+                page_refs = engine.run(
+                    _upload_pages(
+                        s3_client, task_id, imgs_binary, progress, doc_profile
+                    )
+                )
+            else:
+                map_results.update(
+                    engine.run(
+                        _map_pages(
+                            imgs_binary,
+                            replacer,
+                            checkpoint,
+                            progress,
+                            doc_profile,
+                            pages_per_request,
+                        )
+                    )
+                )
+        except Exception as exc:
+            raise _retry(self, task_id, doc_profile, exc)
+
+    if page_refs is not None:
+        return self.replace(
+            _fan_out(
+                task_id,
+                page_refs,
+                pages_count,
+                decode_type,
+                reduce_mode,
+                pages_per_request,
+                doc_profile,
+            )
+        )
+
+    map_results = _ordered_results(self, pages_count, map_results, doc_profile)
+    engine.run(progress.start_reduce(pages_count))
+
+    doc_s3_uuid = _store_result(
+        self,
+        task_id,
+        s3_client,
+        map_results,
+        decode_type,
+        replacer,
+        reduce_mode,
+        doc_profile,
+    )
+    # counted from the checkpoint to include the pages of earlier attempts
+    stats = engine.run(checkpoint.load_stats())
+    _save_profile(
+        task_id, doc_profile, pages_count, stats, decode_type, reduce_mode, self
+    )
+    engine.run(checkpoint.clear())
+    engine.run(progress.clear())
+
+    return {"s3_md_id": doc_s3_uuid, "pages": pages_count, **stats}
+
+
+def _fan_out(
+    doc_id: str,
+    page_refs: List[Tuple[int, str]],
+    pages_count: int,
+    decode_type: str,
+    reduce_mode: str,
+    pages_per_request: int,
+    doc_profile: DocumentProfile,
+):
+    """Chord of map tasks over batches of consecutive pages, its callback
+    reduces the whole document.
+    """
+    batch_size = settings.app_settings.FANOUT_BATCH_PAGES
+    batches = [
+        page_refs[i : i + batch_size] for i in range(0, len(page_refs), batch_size)
+    ]
+    return chord(
+        [
+            map_page_batch.s(doc_id, batch, decode_type, pages_per_request)
+            for batch in batches
+        ],
+        reduce_pages.s(
+            doc_id,
+            pages_count,
+            decode_type,
+            reduce_mode,
+            profile=doc_profile.to_dict(),
+        ),
     )
 
-    response = s3_client.get_object(Bucket=settings.minio_settings.BUCKET, Key=task_id)
-    data = response["Body"].read()
-    imgs_binary = process_file(data, file_type=response["Metadata"]["ext"])
 
-    replacer = REPLACERS[decode_type]
-    imgs_enum = [(idx, img, replacer) for idx, img in enumerate(imgs_binary)]
+def _get_reduce_mode(reduce_mode: str = None) -> str:
+    reduce_mode = reduce_mode or settings.app_settings.REDUCE_MODE
+    if reduce_mode not in REDUCE_MODES:
+        raise ValueError(f"Unknown reduce mode '{reduce_mode}'")
 
-    try:
-        with ThreadPool(len(imgs_enum)) as thread_pool:
-            map_results = thread_pool.starmap(_apply_map_ocr, imgs_enum)
-    except Exception as exc:
-        raise self.retry(exc=exc, countdown=5)
+    return reduce_mode
 
-    reduce_result = _apply_reduce_ocr(map_results, decode_type, replacer)
 
-    doc_s3_uuid = str(uuid4())
+def _resume_profile(task, checkpoint: Checkpoint) -> DocumentProfile:
+    """Profile of the task, set as `current_profile`, picking up the one saved
+    by its failed attempts, if any.
+    """
+    saved = engine.run(checkpoint.load_profile(task.request.id))
+    doc_profile = DocumentProfile.from_dict(saved) if saved else DocumentProfile()
+    current_profile.set(doc_profile)
+    return doc_profile
+
+
+def _retry(task, doc_id: str, doc_profile: DocumentProfile, exc: Exception = None):
+    """`task.retry`, the profile of the failed attempt is kept for the next one."""
     try:
-        s3_client.upload_fileobj(
-            io.BytesIO(reduce_result.encode("utf-8")),
-            settings.minio_settings.BUCKET,
-            doc_s3_uuid,
-            ExtraArgs={"ContentType": "text/markdown"},
+        engine.run(
+            get_checkpoint(doc_id).save_profile(task.request.id, doc_profile.to_dict())
         )
-    except:
-        raise self.retry(exc=exc, countdown=5)
-        
-    pg_session = database.session_factory()
+    except Exception as e:
+        print(f"Failed to save the profile of {task.request.id}: {e}")
+    return task.retry(exc=exc, countdown=5)
+
+
+def _ordered_results(
+    task, pages_count: int, map_results: Dict[int, str], doc_profile: DocumentProfile
+) -> List[str]:
+    """Map results in page order, retries the task while some pages are missing.
+
+    On the last attempt the missing pages are left empty.
+    """
+    failed_pages = [idx for idx in range(pages_count) if idx not in map_results]
+    if failed_pages:
+        if task.request.retries < task.max_retries:
+            raise _retry(task, task.request.id, doc_profile)
+        print(f"Pages {failed_pages} of {task.request.id} failed, leaving them empty")
+
+    return [map_results.get(idx, "") for idx in range(pages_count)]
+
+
+def _store_result(
+    task,
+    doc_id: str,
+    s3_client,
+    texts: List[str],
+    decode_type: str,
+    replacer: tuple,
+    reduce_mode: str,
+    doc_profile: DocumentProfile,
+) -> str:
+    """Reduce map outputs straight into MinIO and link the converted document
+    to its `DocumentDAO`.
+    """
+    doc_s3_uuid = str(uuid4())
+    writer = ResultWriter(
+        s3_client,
+        key=doc_s3_uuid,
+        redis_client=state_redis,
+        preview_key=f"reduce_preview:{doc_id}",
+        part_size=settings.app_settings.RESULT_PART_SIZE,
+        preview_ttl=settings.app_settings.PREVIEW_TTL,
+        preview_max_bytes=settings.app_settings.PREVIEW_MAX_BYTES,
+    )
+    start = time.perf_counter()
+    try:
+        engine.run(_reduce(texts, decode_type, replacer, reduce_mode, writer))
+        engine.run(writer.close())
+        doc_profile.reduce_secs = time.perf_counter() - start
+        doc_profile.bytes_uploaded += writer.bytes_written
+        REDUCE_SECONDS.labels(
+            settings.app_settings.MODEL_NAME, decode_type, reduce_mode
+        ).observe(doc_profile.reduce_secs)
+    except Exception as exc:
+        try:
+            engine.run(writer.abort())
+        except Exception as e:
+            print(f"Failed to abort upload of {doc_s3_uuid}: {e}")
+        raise _retry(task, doc_id, doc_profile, exc)
+
     stmt = (
         update(DocumentDAO)
-        .where(DocumentDAO.id == task_id)
+        .where(DocumentDAO.id == UUID(doc_id))
         .values(s3_md_id=doc_s3_uuid)
     )
-    pg_session.execute(stmt)
-    pg_session.commit()
+    with resources.session() as pg_session:
+        pg_session.execute(stmt)
 
     return doc_s3_uuid
 
 
-def _apply_map_ocr(idx: int, img_binary: str, replacer: tuple):
+def _save_profile(
+    doc_id: str,
+    doc_profile: DocumentProfile,
+    pages_count: int,
+    stats: dict,
+    decode_type: str,
+    reduce_mode: str,
+    task,
+) -> None:
+    """Store the profile of a converted document, replacing an earlier one."""
+    try:
+        with resources.session() as pg_session:
+            pg_session.merge(
+                doc_profile.to_dao(
+                    doc_id,
+                    pages_count,
+                    stats,
+                    decode_type,
+                    reduce_mode,
+                    task.request.retries,
+                )
+            )
+    except Exception as e:
+        print(f"Failed to save the profile of {doc_id}: {e}")
+
+
+@celery.task(name="map_pages", bind=True, time_limit=600, soft_time_limit=540)
+def map_page_batch(
+    self,
+    doc_id: str,
+    page_refs: List[Tuple[int, str]],
+    decode_type: str = "md",
+    pages_per_request: int = 1,
+):
+    """Map a batch of pages uploaded by `process_images` of a large document.
+
+    Never fails: on the last attempt the failed pages are left to the
+    reduce, so that the chord callback always runs.
+    """
+    replacer = REPLACERS[decode_type]
+    checkpoint = get_checkpoint(doc_id)
+    progress = get_progress(self, doc_id)
+    doc_profile = DocumentProfile()
+    current_profile.set(doc_profile)
+
+    try:
+        doc_profile = _resume_profile(self, checkpoint)
+        done = engine.run(checkpoint.load_pages([idx for idx, _ in page_refs]))
+        page_refs = [(idx, kind) for idx, kind in page_refs if idx not in done]
+
+        pages = _load_pages(resources.s3_client, doc_id, page_refs)
+        map_results = engine.run(
+            _map_pages(
+                pages,
+                replacer,
+                checkpoint,
+                progress,
+                doc_profile,
+                pages_per_request,
+                # counted by `_upload_pages` of `process_images`
+                count_rasterized=False,
+            )
+        )
+    except Exception as exc:
+        if self.request.retries < self.max_retries:
+            raise _retry(self, doc_id, doc_profile, exc)
+        print(f"Batch of {doc_id} failed: {exc}")
+        return {"profile": doc_profile.to_dict()}
+
+    if len(map_results) < len(page_refs) and self.request.retries < self.max_retries:
+        raise _retry(self, doc_id, doc_profile)
+
+    return {"profile": doc_profile.to_dict()}
+
+
+@celery.task(
+    name="reduce_pages",
+    bind=True,
+    time_limit=600,
+    soft_time_limit=540,
+    track_started=True,
+)
+def reduce_pages(
+    self,
+    batch_results: List[dict],
+    doc_id: str,
+    pages_count: int,
+    decode_type: str = "md",
+    reduce_mode: str = None,
+    profile: dict = None,
+):
+    """Chord callback of `map_page_batch`, stores the converted document.
+
+    `profile` is the part of the document profile recorded by
+    `process_images` before the fan-out. It is merged with the parts of the
+    batches, unless a failed attempt has saved the merged profile already.
+    """
+    reduce_mode = _get_reduce_mode(reduce_mode)
+    replacer = REPLACERS[decode_type]
+    checkpoint = get_checkpoint(doc_id)
+    progress = get_progress(self, doc_id)
+
+    saved = engine.run(checkpoint.load_profile(self.request.id))
+    if saved:
+        doc_profile = DocumentProfile.from_dict(saved)
+    else:
+        doc_profile = DocumentProfile()
+        doc_profile.merge(profile or {})
+        for batch_result in batch_results:
+            doc_profile.merge(batch_result.get("profile", {}))
+    current_profile.set(doc_profile)
+
+    _, map_results = engine.run(checkpoint.load())
+    failed_pages = [idx for idx in range(pages_count) if idx not in map_results]
+    if failed_pages:
+        print(f"Pages {failed_pages} of {doc_id} failed, leaving them empty")
+    map_results = [map_results.get(idx, "") for idx in range(pages_count)]
+    engine.run(progress.start_reduce(pages_count))
+
+    s3_client = resources.s3_client
+    doc_s3_uuid = _store_result(
+        self,
+        doc_id,
+        s3_client,
+        map_results,
+        decode_type,
+        replacer,
+        reduce_mode,
+        doc_profile,
+    )
+    stats = engine.run(checkpoint.load_stats())
+    _save_profile(
+        doc_id, doc_profile, pages_count, stats, decode_type, reduce_mode, self
+    )
+    _delete_pages(s3_client, doc_id)
+    engine.run(checkpoint.clear())
+    engine.run(progress.clear())
+
+    return {"s3_md_id": doc_s3_uuid, "pages": pages_count, **stats}
+
+
+def _page_key(doc_id: str, idx: int) -> str:
+    return f"pages/{doc_id}/{idx}"
+
+
+async def _upload_pages(
+    s3_client,
+    doc_id: str,
+    pages: Iterable[Page],
+    progress: ProgressReporter,
+    doc_profile: DocumentProfile,
+) -> List[Tuple[int, str]]:
+    """Upload rasterized pages to MinIO for the map tasks of `_fan_out`.
+
+    Like in `_map_pages`, at most `MAP_CONCURRENCY` rasterized pages are
+    waiting for their upload. Blank pages are not uploaded.
+
+    :return: index and kind of every page.
+    """
+    in_flight = asyncio.BoundedSemaphore(settings.app_settings.MAP_CONCURRENCY)
+
+    async def _upload(page: Page):
+        body = page.content.encode("utf-8")
+        try:
+            await to_thread(
+                s3_client.put_object,
+                Bucket=settings.minio_settings.BUCKET,
+                Key=_page_key(doc_id, page.idx),
+                Body=body,
+            )
+            doc_profile.bytes_uploaded += len(body)
+        finally:
+            in_flight.release()
+        await progress.page_rasterized()
+
+    page_refs, uploads = [], []
+    while True:
+        await in_flight.acquire()
+        page = await to_thread(next, pages, None)
+        if page is None:
+            in_flight.release()
+            break
+
+        page_refs.append((page.idx, page.kind))
+        if page.kind == "blank":
+            in_flight.release()
+            await progress.page_rasterized()
+            continue
+        uploads.append(asyncio.create_task(_upload(page)))
+
+    await asyncio.gather(*uploads)
+    return page_refs
+
+
+def _load_pages(s3_client, doc_id: str, page_refs: List[Tuple[int, str]]):
+    """Lazily download the pages uploaded by `_upload_pages`."""
+    for idx, kind in page_refs:
+        if kind == "blank":
+            yield Page(idx, kind, "")
+            continue
+
+        response = s3_client.get_object(
+            Bucket=settings.minio_settings.BUCKET, Key=_page_key(doc_id, idx)
+        )
+        yield Page(idx, kind, response["Body"].read().decode("utf-8"))
+
+
+def _delete_pages(s3_client, doc_id: str) -> None:
+    try:
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for response in paginator.paginate(
+            Bucket=settings.minio_settings.BUCKET, Prefix=f"pages/{doc_id}/"
+        ):
+            keys = [{"Key": obj["Key"]} for obj in response.get("Contents", [])]
+            if keys:
+                s3_client.delete_objects(
+                    Bucket=settings.minio_settings.BUCKET, Delete={"Objects": keys}
+                )
+    except Exception as e:
+        print(f"Failed to delete pages of {doc_id}: {e}")
+
+
+async def _map_pages(
+    pages,
+    replacer: tuple,
+    checkpoint: Checkpoint,
+    progress: ProgressReporter,
+    doc_profile: DocumentProfile,
+    pages_per_request: int = 1,
+    count_rasterized: bool = True,
+) -> Dict[int, str]:
+    """Feed pages to the map stage as soon as they are rasterized.
+
+    The rasterizer is advanced in a thread only when one of the
+    `MAP_CONCURRENCY` slots is free, so it never runs far ahead of OCR.
+    Failed pages are retried with exponential backoff, successful ones are
+    checkpointed right away and only then reported mapped to `progress`,
+    so that a page retried by a later task is counted once. Blank pages
+    get an empty fragment without calling the model, pages with a text
+    layer go through the cheaper text-only prompt. With `pages_per_request`
+    > 1 consecutive page images are packed into one request, pages missing
+    from its output are mapped one by one. Latency, attempts and tokens of
+    every page go to `doc_profile`. Pages are reported rasterized to
+    `progress` unless `count_rasterized` is off, e.g. for pages loaded back
+    from MinIO.
+
+    :return: map results of the successful pages.
+    """
+    in_flight = asyncio.BoundedSemaphore(settings.app_settings.MAP_CONCURRENCY)
+    map_funcs = {"image": _apply_map_ocr, "text": _apply_map_text}
+    # a batch holds a slot per page until it is sent
+    pages_per_request = min(pages_per_request, settings.app_settings.MAP_CONCURRENCY)
+
+    async def _map_page(page: Page):
+        try:
+            if page.kind == "blank":
+                doc_profile.page_mapped(page.idx, page.kind, 0.0, 0, 0)
+                await checkpoint.save_page(page.idx, "", page.kind)
+                await progress.page_mapped()
+                return page.idx, ""
+
+            page_tokens = {"tokens": 0}
+            current_page_tokens.set(page_tokens)
+            start = time.perf_counter()
+            for attempt in range(settings.app_settings.MAP_RETRIES + 1):
+                if attempt:
+                    backoff = settings.app_settings.MAP_BACKOFF * 2 ** (attempt - 1)
+                    await asyncio.sleep(backoff + random.uniform(0, 1))
+
+                content = await map_funcs[page.kind](page.idx, page.content, replacer)
+                if content is not None:
+                    break
+
+            secs = time.perf_counter() - start
+            doc_profile.page_mapped(
+                page.idx, page.kind, secs, attempt + 1, page_tokens["tokens"]
+            )
+            if content is None:
+                return page.idx, None
+
+            MAP_SECONDS.labels(
+                settings.app_settings.MODEL_NAME, replacer[0], page.kind
+            ).observe(secs)
+            await checkpoint.save_page(page.idx, content, page.kind)
+            await progress.page_mapped()
+            return page.idx, content
+        finally:
+            in_flight.release()
+
+    async def _map_batch(batch: List[Page]):
+        if len(batch) == 1:
+            return [await _map_page(batch[0])]
+
+        batch_tokens = {"tokens": 0}
+        current_page_tokens.set(batch_tokens)
+        start = time.perf_counter()
+        packed = await _apply_map_packed(batch, replacer)
+        # pages of one request share its latency and tokens
+        secs = time.perf_counter() - start
+        tokens = batch_tokens["tokens"] // len(batch)
+        results = []
+        for page in batch:
+            if page.idx in packed:
+                doc_profile.page_mapped(page.idx, page.kind, secs, 1, tokens)
+                MAP_SECONDS.labels(
+                    settings.app_settings.MODEL_NAME, replacer[0], page.kind
+                ).observe(secs)
+                try:
+                    await checkpoint.save_page(
+                        page.idx, packed[page.idx], page.kind
+                    )
+                    results.append((page.idx, packed[page.idx]))
+                finally:
+                    in_flight.release()
+                await progress.page_mapped()
+
+        results += await asyncio.gather(
+            *(_map_page(page) for page in batch if page.idx not in packed)
+        )
+        return results
+
+    start = time.perf_counter()
+    map_tasks, batch = [], []
+    while True:
+        await in_flight.acquire()
+        page = await to_thread(next, pages, None)
+        if page is None:
+            in_flight.release()
+            break
+        if count_rasterized:
+            await progress.page_rasterized()
+
+        if page.kind != "image":
+            map_tasks.append(asyncio.create_task(_map_batch([page])))
+            continue
+        batch.append(page)
+        if len(batch) >= pages_per_request:
+            map_tasks.append(asyncio.create_task(_map_batch(batch)))
+            batch = []
+
+    if batch:
+        map_tasks.append(asyncio.create_task(_map_batch(batch)))
+
+    batch_results = await asyncio.gather(*map_tasks)
+    doc_profile.map_secs += time.perf_counter() - start
+    map_results = [result for results in batch_results for result in results]
+    return {idx: content for idx, content in map_results if content is not None}
+
+
+async def _apply_map_ocr(idx: int, img_url: str, replacer: tuple):
+    if settings.app_settings.CACHE_ENABLED:
+        cache_key = page_cache.make_key(img_url, replacer[0], config.DEFAULT_MAP_PROMPT)
+        cached = await page_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
     payload = {
         "model": settings.app_settings.MODEL_NAME,
         "messages": [
@@ -94,7 +641,7 @@ def _apply_map_ocr(idx: int, img_binary: str, replacer: tuple):
                     },
                     {
                         "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{img_binary}"},
+                        "image_url": {"url": img_url},
                     },
                 ],
             }
@@ -102,9 +649,11 @@ def _apply_map_ocr(idx: int, img_binary: str, replacer: tuple):
     }
 
     try:
-        response = client.chat.completions.create(
-            model=settings.app_settings.MODEL_NAME,
-            messages=payload["messages"],
+        response = await engine.complete(
+            payload["messages"],
+            estimate_tokens(payload["messages"][0]["content"][0]["text"])
+            + settings.app_settings.IMAGE_TOKENS
+            + settings.app_settings.COMPLETION_TOKENS,
         )
         content = response.choices[0].message.content
         content = content.lstrip(replacer[1]).rstrip(replacer[2]).strip("\n")
@@ -112,92 +661,211 @@ def _apply_map_ocr(idx: int, img_binary: str, replacer: tuple):
         print(f"An error occurred: {e}")
         return None
 
+    if settings.app_settings.CACHE_ENABLED:
+        await page_cache.set(cache_key, content)
+
     return content
 
 
-def _apply_reduce_ocr(texts: List[str], decode_type: str, replacer: tuple):
-    payload = {
-        "model": settings.app_settings.MODEL_NAME,
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": config.DEFAULT_REDUCE_PROMPT.format(
-                            len(texts),
-                            decode_type,
-                            config.REDUCE_SPLITTER,
-                            decode_type,
-                            f"\n{config.REDUCE_SPLITTER}\n".join(texts),
-                        ),
-                    }
-                ],
-            }
-        ],
-    }
+async def _apply_map_packed(pages: List[Page], replacer: tuple) -> Dict[int, str]:
+    """Map several page images with a single request.
+
+    :return: contents of the pages which are cached or could be parsed out
+        of the response, the rest is left to the single-page requests.
+    """
+    contents, cache_keys = {}, {}
+    if settings.app_settings.CACHE_ENABLED:
+        for page in pages:
+            cache_keys[page.idx] = page_cache.make_key(
+                page.content, replacer[0], config.DEFAULT_PACKED_MAP_PROMPT
+            )
+            cached = await page_cache.get(cache_keys[page.idx])
+            if cached is not None:
+                contents[page.idx] = cached
+
+    pages = [page for page in pages if page.idx not in contents]
+    if len(pages) < 2:
+        return contents
+
+    page_numbers = [page.idx + 1 for page in pages]
+    prompt = config.DEFAULT_PACKED_MAP_PROMPT.format(
+        len(pages),
+        ", ".join(map(str, page_numbers)),
+        replacer[0],
+        config.PAGE_MARKER.format("N"),
+        config.PAGE_MARKER.format(page_numbers[0]),
+        replacer[0],
+        replacer[0],
+    )
+    content = [{"type": "text", "text": prompt}]
+    for page in pages:
+        content.append({"type": "image_url", "image_url": {"url": page.content}})
 
+    page_tokens = (
+        settings.app_settings.IMAGE_TOKENS + settings.app_settings.COMPLETION_TOKENS
+    )
     try:
-        response = client.chat.completions.create(
-            model=settings.app_settings.MODEL_NAME,
-            messages=payload["messages"],
+        response = await engine.complete(
+            [{"role": "user", "content": content}],
+            estimate_tokens(prompt) + len(pages) * page_tokens,
+        )
+        packed = _split_packed(
+            response.choices[0].message.content, page_numbers, replacer
         )
-        content = response.choices[0].message.content
-        content = content.lstrip(replacer[1]).rstrip(replacer[2]).strip("\n")
     except Exception as e:
         print(f"An error occurred: {e}")
-        return None
+        return contents
 
-    return content
+    if packed is None:
+        print(f"Failed to split the output of pages {page_numbers}")
+        return contents
 
+    for idx, page_content in packed.items():
+        contents[idx] = page_content
+        if settings.app_settings.CACHE_ENABLED:
+            await page_cache.set(cache_keys[idx], page_content)
 
-@celery.task(
-    name="texts", bind=True, time_limit=600, soft_time_limit=540, track_started=True
-)
-def process_texts(self, decode_type: str = "md"):
-    task_id = self.request.id
+    return contents
 
-    replacer = REPLACERS[decode_type]
-    if texts == ["unknown"]:
-        return "Unknown data type"
-    texts_enum = [(idx, text, replacer) for idx, text in enumerate(texts)]
 
-    try:
-        with ThreadPool(len(texts_enum)) as thread_pool:
-            map_results = thread_pool.starmap(_apply_map_text, texts_enum)
-    except Exception as exc:
-        raise self.retry(exc=exc, countdown=5)
+def _strip_fence(content: str, replacer: tuple) -> str:
+    content = content.strip()
+    if content.startswith(replacer[1]):
+        content = content[len(replacer[1]) :]
+    if content.endswith(replacer[2]):
+        content = content[: -len(replacer[2])]
+    return content.strip("\n")
 
-    reduce_result = _apply_reduce_text(map_results, decode_type, replacer)
-    return reduce_result
 
+def _split_packed(
+    content: str, page_numbers: List[int], replacer: tuple
+) -> Optional[Dict[int, str]]:
+    """Split output of a packed request on the page markers.
 
-def _apply_map_text(idx: int, text: str, replacer: tuple):
-    payload = {
-        "model": settings.app_settings.MODEL_NAME,
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": config.DEFAULT_MAP_PROMPT.format(
-                            idx + 1, replacer[0], replacer[0], replacer[0]
-                        ),
-                    },
-                    {
-                        "type": "text",
-                        "text": text,
-                    },
-                ],
-            }
-        ],
+    :return: page contents by page index, None unless exactly the requested
+        pages are found in order.
+    """
+    parts = PAGE_MARKER_RE.split(_strip_fence(content, replacer))
+    if parts[0].strip() or [int(n) for n in parts[1::2]] != page_numbers:
+        return None
+
+    return {
+        number - 1: _strip_fence(part, replacer)
+        for number, part in zip(page_numbers, parts[2::2])
     }
 
+
+async def _reduce(
+    texts: List[str],
+    decode_type: str,
+    replacer: tuple,
+    reduce_mode: str,
+    writer: ResultWriter,
+) -> None:
+    """Merge map outputs locally or with the model, depending on the mode.
+
+    In `auto` mode the model is called only when some page break is
+    ambiguous for the local merger.
+    """
+    texts = [text for text in texts if text]  # drop blank pages
+    if not texts:
+        return
+
+    if reduce_mode == "llm":
+        return await _tree_reduce(texts, decode_type, replacer, writer)
+
+    merged, clean = merge_pages(texts, decode_type)
+    if reduce_mode == "local" or clean or len(texts) == 1:
+        return await writer.write(merged)
+
+    del merged
+    return await _tree_reduce(texts, decode_type, replacer, writer)
+
+
+async def _tree_reduce(
+    texts: List[str], decode_type: str, replacer: tuple, writer: ResultWriter
+) -> None:
+    """Merge map outputs in parallel groups until one document is left.
+
+    The fan-in is picked so that a group fits `REDUCE_MAX_TOKENS`, hence the
+    number of sequential reduce rounds grows logarithmically with the page
+    count. Only the last round is streamed into `writer`. Results too large
+    to be merged by the model are concatenated.
+    """
+    budget = settings.app_settings.REDUCE_MAX_TOKENS
+    reduced = False
+
+    while len(texts) > 1:
+        tokens = [estimate_tokens(text) for text in texts]
+        if sum(tokens) <= budget:
+            break
+
+        avg_tokens = sum(tokens) / len(texts)
+        if 2 * avg_tokens > budget:
+            return await _write_joined(texts, writer)
+
+        fan_in = int(budget // avg_tokens)
+        groups = [texts[i : i + fan_in] for i in range(0, len(texts), fan_in)]
+        texts = await asyncio.gather(
+            *(
+                _reduce_group(group, decode_type, replacer)
+                if len(group) > 1
+                else _passthrough(group[0])
+                for group in groups
+            )
+        )
+        reduced = True
+
+    if reduced and len(texts) == 1:
+        return await writer.write(texts[0])
+
+    await _stream_reduce(texts, decode_type, replacer, writer)
+
+
+async def _write_joined(texts: List[str], writer: ResultWriter) -> None:
+    for i, text in enumerate(texts):
+        await writer.write(f"\n\n{text}" if i else text)
+
+
+async def _passthrough(text: str) -> str:
+    return text
+
+
+async def _reduce_group(texts: List[str], decode_type: str, replacer: tuple) -> str:
+    result = await _apply_reduce_ocr(texts, decode_type, replacer)
+    if result is None:
+        # keep the content of the group if the model fails to merge it
+        return "\n\n".join(texts)
+
+    return result
+
+
+def _reduce_messages(texts: List[str], decode_type: str) -> list:
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": config.DEFAULT_REDUCE_PROMPT.format(
+                        len(texts),
+                        decode_type,
+                        config.REDUCE_SPLITTER,
+                        decode_type,
+                        f"\n{config.REDUCE_SPLITTER}\n".join(texts),
+                    ),
+                }
+            ],
+        }
+    ]
+
+
+async def _apply_reduce_ocr(texts: List[str], decode_type: str, replacer: tuple):
+    messages = _reduce_messages(texts, decode_type)
+
     try:
-        response = client.chat.completions.create(
-            model=settings.app_settings.MODEL_NAME,
-            messages=payload["messages"],
+        response = await engine.complete(
+            messages, 2 * estimate_tokens(messages[0]["content"][0]["text"])
         )
         content = response.choices[0].message.content
         content = content.lstrip(replacer[1]).rstrip(replacer[2]).strip("\n")
@@ -208,7 +876,110 @@ def _apply_map_text(idx: int, text: str, replacer: tuple):
     return content
 
 
-def _apply_reduce_text(texts: List[str], decode_type: str, replacer: tuple):
+async def _stream_reduce(
+    texts: List[str], decode_type: str, replacer: tuple, writer: ResultWriter
+) -> None:
+    """Final reduce call, its completion is written out as it streams in.
+
+    If the call fails before anything has been written, the group is
+    concatenated like in `_reduce_group`; a stream broken midway can not be
+    taken back, so the error is raised and the task retried.
+    """
+    messages = _reduce_messages(texts, decode_type)
+    tokens = estimate_tokens(messages[0]["content"][0]["text"])
+    fence = FenceStripper(replacer[1], replacer[2])
+
+    try:
+        async for delta in engine.stream(messages, tokens, tokens):
+            await writer.write(fence.feed(delta))
+        await writer.write(fence.finish())
+    except Exception as e:
+        if writer.bytes_written:
+            raise
+        print(f"An error occurred: {e}")
+        await _write_joined(texts, writer)
+
+
+@celery.task(name="cache_stats")
+def cache_stats():
+    """Hit/miss counters of the page OCR cache."""
+    return engine.run(page_cache.stats())
+
+
+@celery.task(
+    name="texts", bind=True, time_limit=600, soft_time_limit=540, track_started=True
+)
+def process_texts(self, decode_type: str = "md", reduce_mode: str = None):
+    task_id = self.request.id
+    reduce_mode = _get_reduce_mode(reduce_mode)
+
+    replacer = REPLACERS[decode_type]
+    checkpoint = get_checkpoint(task_id)
+    progress = get_progress(self)
+    chunks_count, map_results = engine.run(checkpoint.load())
+    doc_profile = _resume_profile(self, checkpoint)
+
+    s3_client = resources.s3_client
+
+    # resume from the checkpoint, map only the missing chunks
+    if chunks_count is None or len(map_results) < chunks_count:
+        response = s3_client.get_object(
+            Bucket=settings.minio_settings.BUCKET, Key=task_id
+        )
+        text = response["Body"].read().decode("utf-8", errors="replace")
+        chunks = split_text(text, settings.app_settings.TEXT_CHUNK_TOKENS)
+        chunks_count = len(chunks)
+
+        pages = iter(
+            [
+                Page(idx, "text", chunk)
+                for idx, chunk in enumerate(chunks)
+                if idx not in map_results
+            ]
+        )
+        try:
+            engine.run(checkpoint.set_pages_count(chunks_count))
+            engine.run(progress.start(chunks_count, len(map_results)))
+            map_results.update(
+                engine.run(
+                    _map_pages(pages, replacer, checkpoint, progress, doc_profile)
+                )
+            )
+        except Exception as exc:
+            raise _retry(self, task_id, doc_profile, exc)
+
+    map_results = _ordered_results(self, chunks_count, map_results, doc_profile)
+    engine.run(progress.start_reduce(chunks_count))
+
+    doc_s3_uuid = _store_result(
+        self,
+        task_id,
+        s3_client,
+        map_results,
+        decode_type,
+        replacer,
+        reduce_mode,
+        doc_profile,
+    )
+    stats = engine.run(checkpoint.load_stats())
+    _save_profile(
+        task_id, doc_profile, chunks_count, stats, decode_type, reduce_mode, self
+    )
+    engine.run(checkpoint.clear())
+    engine.run(progress.clear())
+
+    return {"s3_md_id": doc_s3_uuid, "chunks": chunks_count}
+
+
+async def _apply_map_text(idx: int, text: str, replacer: tuple):
+    if settings.app_settings.CACHE_ENABLED:
+        cache_key = page_cache.make_key(
+            text, replacer[0], config.DEFAULT_TEXT_MAP_PROMPT
+        )
+        cached = await page_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
     payload = {
         "model": settings.app_settings.MODEL_NAME,
         "messages": [
@@ -217,23 +988,20 @@ def _apply_reduce_text(texts: List[str], decode_type: str, replacer: tuple):
                 "content": [
                     {
                         "type": "text",
-                        "text": config.DEFAULT_REDUCE_PROMPT.format(
-                            len(texts),
-                            decode_type,
-                            config.REDUCE_SPLITTER,
-                            decode_type,
-                            f"\n{config.REDUCE_SPLITTER}\n".join(texts),
+                        "text": config.DEFAULT_TEXT_MAP_PROMPT.format(
+                            idx + 1, replacer[0], replacer[0], replacer[0], text
                         ),
-                    }
+                    },
                 ],
             }
         ],
     }
 
     try:
-        response = client.chat.completions.create(
-            model=settings.app_settings.MODEL_NAME,
-            messages=payload["messages"],
+        response = await engine.complete(
+            payload["messages"],
+            estimate_tokens(payload["messages"][0]["content"][0]["text"])
+            + 2 * estimate_tokens(text),
         )
         content = response.choices[0].message.content
         content = content.lstrip(replacer[1]).rstrip(replacer[2]).strip("\n")
@@ -241,4 +1009,7 @@ def _apply_reduce_text(texts: List[str], decode_type: str, replacer: tuple):
         print(f"An error occurred: {e}")
         return None
 
+    if settings.app_settings.CACHE_ENABLED:
+        await page_cache.set(cache_key, content)
+
     return content
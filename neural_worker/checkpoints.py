@@ -0,0 +1,86 @@
+import json
+from typing import Dict, List, Optional, Tuple
+
+from redis import asyncio as aioredis
+
+import settings
+from rate_limiter import state_redis
+
+
+class Checkpoint:
+    """Map results of a single task, saved page by page as they complete.
+
+    A retried or restarted task loads them back and only maps the pages
+    which are still missing. The kind of every page is saved next to its
+    result, so that the page stats of the document survive the retries,
+    and so is the profile of the failed attempts of every task working on
+    the document.
+    """
+
+    def __init__(self, redis_client: aioredis.Redis, task_id: str, ttl: int) -> None:
+        self.redis = redis_client
+        self.key = f"checkpoint:{task_id}"
+        self.ttl = ttl
+
+    async def load(self) -> Tuple[Optional[int], Dict[int, str]]:
+        """:return: pages count (None if unknown yet) and mapped pages."""
+        fields = await self.redis.hgetall(self.key)
+
+        pages_count = fields.pop(b"pages", None)
+        pages = {
+            int(idx): content.decode("utf-8")
+            for idx, content in fields.items()
+            if idx.isdigit()
+        }
+
+        return pages_count and int(pages_count), pages
+
+    async def load_pages(self, idxs: List[int]) -> Dict[int, str]:
+        """:return: mapped pages among `idxs`."""
+        if not idxs:
+            return {}
+        contents = await self.redis.hmget(self.key, [str(idx) for idx in idxs])
+        return {
+            idx: content.decode("utf-8")
+            for idx, content in zip(idxs, contents)
+            if content is not None
+        }
+
+    async def set_pages_count(self, pages_count: int) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(self.key, "pages", pages_count)
+            pipe.expire(self.key, self.ttl)
+            await pipe.execute()
+
+    async def load_stats(self) -> Dict[str, int]:
+        """:return: blank and text-layer pages among the mapped ones."""
+        fields = await self.redis.hgetall(self.key)
+        kinds = [kind for idx, kind in fields.items() if idx.startswith(b"kind:")]
+        return {
+            "blank_pages": kinds.count(b"blank"),
+            "text_pages": kinds.count(b"text"),
+        }
+
+    async def save_page(self, idx: int, content: str, kind: str) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(self.key, mapping={str(idx): content, f"kind:{idx}": kind})
+            pipe.expire(self.key, self.ttl)
+            await pipe.execute()
+
+    async def load_profile(self, task_id: str) -> Optional[dict]:
+        """:return: profile saved by the previous attempt of the task."""
+        profile = await self.redis.hget(self.key, f"profile:{task_id}")
+        return profile and json.loads(profile)
+
+    async def save_profile(self, task_id: str, profile: dict) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(self.key, f"profile:{task_id}", json.dumps(profile))
+            pipe.expire(self.key, self.ttl)
+            await pipe.execute()
+
+    async def clear(self) -> None:
+        await self.redis.delete(self.key)
+
+
+def get_checkpoint(task_id: str) -> Checkpoint:
+    return Checkpoint(state_redis, task_id, settings.app_settings.CHECKPOINT_TTL)
@@ -6,6 +6,27 @@ Wrap inline equations with '$ EQUATION $' and separate with '$$\\n EQUATION \\n$
 Write nothing more but {}.
 Always put '```{}' before and '```' after doc respectively
 """
+DEFAULT_TEXT_MAP_PROMPT = """
+The given text is extracted from the {}st page of the document, its layout is preserved with spaces.
+Decode it into {} markup preserving every text block, table etc.
+Restore headings, lists and tables from the layout, fix hyphenated words.
+Wrap inline equations with '$ EQUATION $' and separate with '$$\\n EQUATION \\n$$'. DONT PLACE ANY MUMBERS AFTER IT!
+Write nothing more but {}.
+Always put '```{}' before and '```' after doc respectively
+
+Text:
+{}
+"""
+DEFAULT_PACKED_MAP_PROMPT = """
+The given {} images are the pages {} of the document, in this order.
+Decode each of them into {} markup preserving every text block, table etc.
+Ignore all the images in document.
+Wrap inline equations with '$ EQUATION $' and separate with '$$\\n EQUATION \\n$$'. DONT PLACE ANY MUMBERS AFTER IT!
+Start the decoded text of every page with a separate line '{}' holding its page number, e.g. '{}'.
+Write nothing more but {}.
+Always put '```{}' before and '```' after doc respectively
+"""
+PAGE_MARKER = "===PAGE {}==="
 MD_REPLACER = ("md", "```md", "```")
 LATEX_REPLACER = ("latex", "```latex", "```")
 
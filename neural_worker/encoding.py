@@ -0,0 +1,85 @@
+import base64
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Optional
+
+from PIL import Image
+
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+@dataclass(frozen=True)
+class EncodingProfile:
+    """How a rendered page is turned into the image sent to the model."""
+
+    dpi: int = 200
+    long_edge: Optional[int] = None  # px, None keeps the rendered size
+    format: str = "JPEG"  # JPEG | WEBP | PNG
+    quality: int = 75
+    grayscale: bool = False
+    crop_margins: bool = False
+
+
+ENCODING_PROFILES = {
+    # pdf2image and PIL defaults
+    "default": EncodingProfile(),
+    "balanced": EncodingProfile(
+        dpi=150, long_edge=1600, quality=80, crop_margins=True
+    ),
+    "compact": EncodingProfile(
+        dpi=150,
+        long_edge=1280,
+        format="WEBP",
+        quality=70,
+        grayscale=True,
+        crop_margins=True,
+    ),
+    "quality": EncodingProfile(
+        dpi=300, long_edge=2048, quality=90, crop_margins=True
+    ),
+}
+
+
+def get_profile(name: str) -> EncodingProfile:
+    if name not in ENCODING_PROFILES:
+        raise ValueError(f"Unknown encoding profile '{name}'")
+    return ENCODING_PROFILES[name]
+
+
+def crop_whitespace(img: Image.Image, threshold: int = 245, pad: int = 16):
+    """Crop the blank page margins, keeping `pad` px around the content."""
+    ink = img.convert("L").point(lambda p: 255 if p < threshold else 0)
+    bbox = ink.getbbox()
+    if bbox is None:
+        return img
+
+    left, upper, right, lower = bbox
+    return img.crop(
+        (
+            max(left - pad, 0),
+            max(upper - pad, 0),
+            min(right + pad, img.width),
+            min(lower + pad, img.height),
+        )
+    )
+
+
+def encode_page(img: Image.Image, profile: EncodingProfile) -> str:
+    """:return: page image as a base64 data URL."""
+    if profile.crop_margins:
+        img = crop_whitespace(img)
+    if profile.grayscale and img.mode != "L":
+        img = img.convert("L")
+    if profile.long_edge and max(img.size) > profile.long_edge:
+        img = img.copy()
+        img.thumbnail((profile.long_edge, profile.long_edge), Image.LANCZOS)
+
+    buffered = BytesIO()
+    if profile.format == "PNG":
+        img.save(buffered, format="PNG", optimize=True)
+    else:
+        img.save(buffered, format=profile.format, quality=profile.quality)
+
+    data = base64.b64encode(buffered.getvalue()).decode()
+    return f"data:{MIME_TYPES[profile.format]};base64,{data}"
@@ -10,6 +10,9 @@ class Base(DeclarativeBase):
 
 engine = create_engine(
     postgres_settings.URI,  # Изменено
+    pool_size=postgres_settings.POOL_SIZE,
+    max_overflow=postgres_settings.MAX_OVERFLOW,
+    pool_pre_ping=True,
 )
 session_factory = sessionmaker(
     bind=engine,  # Изменено
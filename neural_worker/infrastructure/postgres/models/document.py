@@ -2,7 +2,16 @@ import uuid
 import enum
 from datetime import datetime
 
-from sqlalchemy import String, TIMESTAMP, Enum
+from sqlalchemy import (
+    JSON,
+    BigInteger,
+    Enum,
+    Float,
+    ForeignKey,
+    Integer,
+    String,
+    TIMESTAMP,
+)
 from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy.sql import func
 
@@ -22,7 +31,43 @@ class DocumentDAO(Base):
     name: Mapped[str] = mapped_column(String(100))
     s3_md_id: Mapped[str] = mapped_column(String(50), nullable=True)
     s3_raw_id: Mapped[str] = mapped_column(String(50), nullable=True)
+    content_hash: Mapped[str] = mapped_column(String(64), nullable=True, index=True)
+    decode_type: Mapped[str] = mapped_column(String(10), nullable=True)
+    pages_count: Mapped[int] = mapped_column(Integer, nullable=True)
     upload_date: Mapped[datetime] = mapped_column(TIMESTAMP, server_default=func.now())
     common_share_role_type: Mapped[ShareRoleEnum] = mapped_column(
         type_=Enum(ShareRoleEnum), default=ShareRoleEnum.private
     )
+
+
+class DocumentProfileDAO(Base):
+    """Where the time of the last conversion of a document went."""
+
+    __tablename__ = "document_profiles"
+
+    document_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey("documents.id"), primary_key=True
+    )
+    finished_at: Mapped[datetime] = mapped_column(
+        TIMESTAMP, server_default=func.now(), index=True
+    )
+    decode_type: Mapped[str] = mapped_column(String(10), nullable=True)
+    reduce_mode: Mapped[str] = mapped_column(String(10), nullable=True)
+    pages_count: Mapped[int] = mapped_column(Integer, nullable=True)
+    blank_pages: Mapped[int] = mapped_column(Integer, default=0)
+    text_pages: Mapped[int] = mapped_column(Integer, default=0)
+    task_retries: Mapped[int] = mapped_column(Integer, default=0)
+    map_retries: Mapped[int] = mapped_column(Integer, default=0)
+    llm_calls: Mapped[int] = mapped_column(Integer, default=0)
+    prompt_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    completion_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    # secs
+    rasterize_secs: Mapped[float] = mapped_column(Float, nullable=True)
+    map_secs: Mapped[float] = mapped_column(Float, nullable=True)
+    map_latency_p50: Mapped[float] = mapped_column(Float, nullable=True)
+    map_latency_p95: Mapped[float] = mapped_column(Float, nullable=True)
+    reduce_secs: Mapped[float] = mapped_column(Float, nullable=True)
+    total_secs: Mapped[float] = mapped_column(Float, nullable=True)
+    bytes_uploaded: Mapped[int] = mapped_column(BigInteger, default=0)
+    # idx, kind, secs, attempts and tokens of every mapped page
+    pages: Mapped[list] = mapped_column(JSON, nullable=True)
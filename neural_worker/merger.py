@@ -0,0 +1,198 @@
+import re
+from collections import Counter
+from typing import List, Optional, Tuple
+
+
+PAGE_NUMBER_RE = re.compile(
+    r"^\W*(page|стр\.?)?\s*\d+(\s*(of|/|из)\s*\d+)?\W*$", re.I
+)
+# page number set apart at the edge of a running line, e.g. "Report | 12",
+# "Report, p. 12", unlike the number of a heading like "Problem 3"
+EDGE_PAGE_NUMBER_RE = re.compile(
+    r"^\d+\s*[|,·•—–-]|([|,·•—–-]|\bpage|\bp\.|\bстр\.?)\s*\d+$", re.I
+)
+TABLE_SEPARATOR_RE = re.compile(r"^\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)*\|?$")
+PREAMBLE_RE = re.compile(
+    r"^\s*(\\documentclass|\\usepackage|\\begin\{document\}|\\end\{document\})"
+)
+BLOCK_START_RE = re.compile(r"^(#|[-*+] |\d+[.)] |\$\$|```|>|\\[a-zA-Z]|\||!\[)")
+# headings (`#`, `\section`), tables, equations and code are never running lines
+MARKUP_RE = re.compile(r"^(#|\||\$\$|```|\\)")
+SENTENCE_END = (".", "!", "?", ":", ";", "$$", "```", "}")
+
+HEADER_FOOTER_SHARE = 0.6  # of pages a line has to repeat on to be dropped
+HEADER_FOOTER_MAX_CHARS = 80  # longer lines are content
+
+
+def merge_pages(pages: List[Optional[str]], decode_type: str) -> Tuple[str, bool]:
+    """Deterministic local replacement of the LLM reduce call.
+
+    Drops running headers/footers and page numbers, glues tables and
+    paragraphs split by a page break and, for LaTeX, hoists the preamble
+    of all pages into a single one.
+
+    :return: merged document and whether every page break was unambiguous.
+    """
+    pages = [page.strip("\n") for page in pages if page and page.strip()]
+    if not pages:
+        return "", True
+
+    pages_lines = [page.splitlines() for page in pages]
+
+    preamble = []
+    if decode_type == "latex":
+        preamble = _hoist_preamble(pages_lines)
+
+    _drop_running_lines(pages_lines)
+
+    document = pages_lines[0]
+    clean = _is_balanced(document)
+    for lines in pages_lines[1:]:
+        clean &= _join_page(document, lines)
+        clean &= _is_balanced(lines)
+
+    body = "\n".join(document).strip("\n")
+    if decode_type == "latex":
+        body = "\n".join(preamble + ["\\begin{document}", body, "\\end{document}"])
+
+    return body, clean
+
+
+def _normalize(line: str) -> str:
+    """Comparison key of a line, a page number at its edge is masked."""
+    return EDGE_PAGE_NUMBER_RE.sub("#", line.strip().lower())
+
+
+def _edge_index(lines: List[str], last: bool) -> Optional[int]:
+    indexes = range(len(lines) - 1, -1, -1) if last else range(len(lines))
+    for idx in indexes:
+        if lines[idx].strip():
+            return idx
+    return None
+
+
+def _is_running_candidate(lines: List[str], idx: int) -> bool:
+    """Edge line short enough for a header/footer, on a page holding more."""
+    line = lines[idx].strip()
+    return (
+        len(line) <= HEADER_FOOTER_MAX_CHARS
+        and not MARKUP_RE.match(line)
+        and sum(1 for other in lines if other.strip()) > 1
+    )
+
+
+def _drop_running_lines(pages_lines: List[List[str]]) -> None:
+    """Remove page numbers and headers/footers repeated across pages.
+
+    Only short edge lines which are neither headings nor other markup are
+    considered, and never the only line of a page.
+    """
+    for last in (False, True):
+        edges = [_edge_index(lines, last) for lines in pages_lines]
+        counts = Counter(
+            _normalize(lines[idx])
+            for lines, idx in zip(pages_lines, edges)
+            if idx is not None and _is_running_candidate(lines, idx)
+        )
+        min_count = max(2, HEADER_FOOTER_SHARE * len(pages_lines))
+
+        for lines, idx in zip(pages_lines, edges):
+            if idx is None or MARKUP_RE.match(lines[idx].strip()):
+                continue
+            line = lines[idx]
+            if PAGE_NUMBER_RE.match(line.strip()) or (
+                len(pages_lines) > 2
+                and _is_running_candidate(lines, idx)
+                and counts[_normalize(line)] >= min_count
+            ):
+                del lines[idx]
+
+
+def _hoist_preamble(pages_lines: List[List[str]]) -> List[str]:
+    documentclass, packages = None, []
+    for lines in pages_lines:
+        body = []
+        for line in lines:
+            if not PREAMBLE_RE.match(line):
+                body.append(line)
+            elif line.strip().startswith("\\documentclass"):
+                documentclass = documentclass or line.strip()
+            elif line.strip().startswith("\\usepackage"):
+                if line.strip() not in packages:
+                    packages.append(line.strip())
+        lines[:] = body
+
+    return [documentclass or "\\documentclass{article}"] + packages
+
+
+def _is_table_row(line: str) -> bool:
+    return line.strip().startswith("|")
+
+
+def _is_balanced(lines: List[str]) -> bool:
+    """Page does not leave an equation, code block or environment open."""
+    text = "\n".join(lines)
+    return (
+        text.count("$$") % 2 == 0
+        and text.count("```") % 2 == 0
+        and text.count("\\begin{") == text.count("\\end{")
+    )
+
+
+def _join_page(document: List[str], lines: List[str]) -> bool:
+    """Append page `lines` to `document` in place.
+
+    :return: False if it is unclear whether the page break splits a block.
+    """
+    head_idx = _edge_index(lines, last=False)
+    tail_idx = _edge_index(document, last=True)
+    if head_idx is None or tail_idx is None:
+        document.extend(lines)
+        return True
+
+    del document[tail_idx + 1 :]
+    lines = lines[head_idx:]
+    tail, head = document[-1].rstrip(), lines[0].strip()
+
+    # table continued on the next page, skip its repeated header
+    if _is_table_row(tail) and _is_table_row(head):
+        if len(lines) > 1 and TABLE_SEPARATOR_RE.match(lines[1].strip()):
+            header_idx = _table_header_index(document)
+            same_table = header_idx is not None and _normalize(
+                document[header_idx]
+            ) == _normalize(head)
+            if not same_table:
+                document.extend([""] + lines)
+                return True
+            lines = lines[2:]
+        document.extend(lines)
+        return True
+
+    # word hyphenated over the page break
+    if tail.endswith("-") and head[:1].islower():
+        document[-1] = tail[:-1] + lines[0].lstrip()
+        document.extend(lines[1:])
+        return True
+
+    # sentence continued on the next page
+    if not tail.endswith(SENTENCE_END) and head[:1].islower():
+        document[-1] = f"{tail} {lines[0].lstrip()}"
+        document.extend(lines[1:])
+        return True
+
+    document.extend([""] + lines)
+    ends_block = tail.endswith(SENTENCE_END) or BLOCK_START_RE.match(tail.lstrip())
+    return bool(ends_block) and (
+        head[:1].isupper() or BLOCK_START_RE.match(head) is not None
+    )
+
+
+def _table_header_index(document: List[str]) -> Optional[int]:
+    idx = len(document) - 1
+    while idx > 0 and _is_table_row(document[idx - 1]):
+        idx -= 1
+    if idx + 1 < len(document) and TABLE_SEPARATOR_RE.match(
+        document[idx + 1].strip()
+    ):
+        return idx
+    return None
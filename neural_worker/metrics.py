@@ -0,0 +1,114 @@
+import asyncio
+import os
+import shutil
+
+import settings
+
+# the prefork processes write their samples to files in this directory, the
+# exporter of the main process aggregates them; it has to be set before
+# prometheus_client is imported
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", settings.app_settings.METRICS_DIR)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+from celery.signals import worker_init, worker_process_shutdown  # noqa: E402
+from prometheus_client import (  # noqa: E402
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    multiprocess,
+    start_http_server,
+)
+
+
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 180, 300, 600)
+
+RASTERIZE_SECONDS = Histogram(
+    "nw_rasterize_page_seconds",
+    "Time to turn one page into model input, by stage",
+    ["stage"],  # text_layer | render | encode
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+MAP_SECONDS = Histogram(
+    "nw_map_page_seconds",
+    "Map latency of one page, retries included",
+    ["model", "decode_type", "kind"],
+    buckets=LATENCY_BUCKETS,
+)
+REDUCE_SECONDS = Histogram(
+    "nw_reduce_seconds",
+    "Reduce latency of one document, upload of the result included",
+    ["model", "decode_type", "reduce_mode"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_SECONDS = Histogram(
+    "nw_llm_request_seconds",
+    "Latency of one LLM call, rate limiter wait included",
+    ["model"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_ERRORS = Counter(
+    "nw_llm_errors_total",
+    "Failed LLM calls, by HTTP status (429 for rate limited calls)",
+    ["model", "status"],
+)
+LLM_TOKENS = Counter(
+    "nw_llm_tokens_total",
+    "Tokens of the LLM calls, streamed completions are estimated",
+    ["model", "type"],  # prompt | completion
+)
+LLM_IN_FLIGHT = Gauge(
+    "nw_llm_in_flight",
+    "LLM calls in flight",
+    ["model"],
+    multiprocess_mode="livesum",
+)
+THREADS_BUSY = Gauge(
+    "nw_threads_busy",
+    "Blocking calls (rasterization, S3) running in the default thread pool",
+    multiprocess_mode="livesum",
+)
+
+
+async def to_thread(func, *args, **kwargs):
+    """`asyncio.to_thread` accounted in `THREADS_BUSY`."""
+    THREADS_BUSY.inc()
+    try:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    finally:
+        THREADS_BUSY.dec()
+
+
+def error_status(exc: Exception) -> str:
+    """Label of a failed LLM call: HTTP status, `timeout` or `error`."""
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return str(status)
+    if "Timeout" in type(exc).__name__:
+        return "timeout"
+    return "error"
+
+
+@worker_init.connect
+def start_exporter(**kwargs):
+    """Serve the metrics of all the pool processes from the main one."""
+    port = settings.app_settings.METRICS_PORT
+    if port <= 0:
+        return
+
+    # samples of a previous run would be summed up with the new ones
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    try:
+        start_http_server(port, registry=registry)
+    except OSError as e:
+        print(f"Failed to start the metrics exporter on port {port}: {e}")
+
+
+@worker_process_shutdown.connect
+def mark_process_dead(pid=None, **kwargs):
+    multiprocess.mark_process_dead(pid or os.getpid())
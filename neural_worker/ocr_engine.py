@@ -0,0 +1,177 @@
+import asyncio
+import time
+from contextlib import contextmanager
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+import settings
+from metrics import LLM_ERRORS, LLM_IN_FLIGHT, LLM_SECONDS, LLM_TOKENS, error_status
+from profiling import record_usage
+from rate_limiter import limiter
+
+
+class OCREngine:
+    """Asyncio runner for the LLM calls of one worker process.
+
+    Owns a persistent event loop and a single `AsyncOpenAI` client with a
+    keep-alive connection pool, so consecutive tasks reuse the connections.
+    Both are created lazily, i.e. after Celery has forked the pool process.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str,
+        max_connections: int,
+        max_keepalive_connections: int,
+        keepalive_expiry: float,
+        concurrency: int,
+        timeout: float,
+    ) -> None:
+        self.api_key = api_key
+        self.base_url = base_url
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+        self._loop = None
+        self._client = None
+        self._semaphore = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+            self._client = None
+        return self._loop
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        if self._client is None:
+            self._client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url or None,
+                timeout=self.timeout,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=self.limits, timeout=self.timeout
+                ),
+            )
+            self._semaphore = asyncio.BoundedSemaphore(self.concurrency)
+        return self._client
+
+    def run(self, coro):
+        """Run coroutine to completion on the process-wide loop.
+
+        If it fails or is interrupted (e.g. `SoftTimeLimitExceeded`), the
+        tasks it spawned are cancelled before returning, so that none of
+        them keeps running during the next call.
+        """
+        loop = self.loop
+        try:
+            return loop.run_until_complete(coro)
+        except BaseException:
+            self._cancel_pending(loop)
+            raise
+
+    @staticmethod
+    def _cancel_pending(loop: asyncio.AbstractEventLoop) -> None:
+        pending = asyncio.all_tasks(loop)
+        if not pending:
+            return
+        for task in pending:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+    async def complete(self, messages: list, estimated_tokens: int):
+        """Chat completion call drawing from the cluster-wide rate limit.
+
+        At most `concurrency` calls of the process are in flight at once,
+        each one bounded by `timeout` secs.
+        """
+        client = self.client
+        model = settings.app_settings.MODEL_NAME
+        async with self._semaphore:
+            with self._observe(model):
+                await limiter.acquire(estimated_tokens)
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    timeout=self.timeout,
+                )
+
+        if response.usage:
+            LLM_TOKENS.labels(model, "prompt").inc(response.usage.prompt_tokens)
+            LLM_TOKENS.labels(model, "completion").inc(
+                response.usage.completion_tokens
+            )
+            record_usage(response.usage.prompt_tokens, response.usage.completion_tokens)
+            await limiter.consume(response.usage.total_tokens - estimated_tokens)
+
+        return response
+
+    async def stream(self, messages: list, prompt_tokens: int, completion_tokens: int):
+        """Streaming version of `complete`, yields the content deltas.
+
+        Streamed responses carry no usage, so the rate limit is settled with
+        the token estimate of the received text.
+        """
+        client = self.client
+        model = settings.app_settings.MODEL_NAME
+        received = 0
+        async with self._semaphore:
+            with self._observe(model):
+                await limiter.acquire(prompt_tokens + completion_tokens)
+                stream = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    timeout=self.timeout,
+                    stream=True,
+                )
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        received += len(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+
+        LLM_TOKENS.labels(model, "prompt").inc(prompt_tokens)
+        LLM_TOKENS.labels(model, "completion").inc(received // 4 + 1)
+        record_usage(prompt_tokens, received // 4 + 1)
+        await limiter.consume(received // 4 + 1 - completion_tokens)
+
+    @contextmanager
+    def _observe(self, model: str):
+        """Latency, in-flight count and errors of one call."""
+        in_flight = LLM_IN_FLIGHT.labels(model)
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            LLM_ERRORS.labels(model, error_status(e)).inc()
+            raise
+        finally:
+            in_flight.dec()
+            LLM_SECONDS.labels(model).observe(time.perf_counter() - start)
+
+    def close(self) -> None:
+        if self._loop is None or self._loop.is_closed():
+            return
+        if self._client is not None:
+            self._loop.run_until_complete(self._client.close())
+        self._loop.close()
+        self._client = None
+
+
+engine = OCREngine(
+    api_key=settings.app_settings.OPENAI_KEY,
+    base_url=settings.app_settings.BASE_OPENAI_URL,
+    max_connections=settings.app_settings.LLM_MAX_CONNECTIONS,
+    max_keepalive_connections=settings.app_settings.LLM_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=settings.app_settings.LLM_KEEPALIVE_EXPIRY,
+    concurrency=settings.app_settings.LLM_CONCURRENCY,
+    timeout=settings.app_settings.LLM_TIMEOUT,
+)
@@ -0,0 +1,141 @@
+import statistics
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+from uuid import UUID
+
+from sqlalchemy.sql import func
+
+from infrastructure.postgres.models import DocumentProfileDAO
+
+
+class DocumentProfile:
+    """Where the time of one document went, saved to `document_profiles`.
+
+    Rasterization time and LLM usage are reported from deep inside the
+    pipeline (the rasterizer thread, `ocr_engine`) through `current_profile`,
+    the rest is recorded by the tasks. The tasks of a fanned out document
+    pass their part along as a dict, see `to_dict` and `merge`. A retried
+    task picks up the profile of its failed attempts from the checkpoint,
+    see `from_dict`.
+    """
+
+    def __init__(self, started_at: float = None) -> None:
+        self.started_at = started_at or time.time()
+        self.rasterize_secs = 0.0
+        self.map_secs = 0.0
+        self.reduce_secs = 0.0
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.map_retries = 0
+        self.bytes_uploaded = 0
+        self.pages: List[dict] = []
+
+    def add_usage(self, prompt_tokens: int, completion_tokens: int) -> None:
+        self.llm_calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+
+    def page_mapped(
+        self, idx: int, kind: str, secs: float, attempts: int, tokens: int
+    ) -> None:
+        self.map_retries += max(attempts - 1, 0)
+        self.pages.append(
+            {
+                "idx": idx,
+                "kind": kind,
+                "secs": round(secs, 3),
+                "attempts": attempts,
+                "tokens": tokens,
+            }
+        )
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DocumentProfile":
+        """Profile recorded so far by earlier attempts of a task, see `to_dict`."""
+        profile = cls()
+        vars(profile).update(data)
+        return profile
+
+    def merge(self, other: dict) -> None:
+        for key, value in other.items():
+            if key == "started_at":
+                self.started_at = min(self.started_at, value)
+            elif key == "pages":
+                self.pages += value
+            elif key == "map_secs":
+                # batches of a fanned out document are mapped side by side
+                self.map_secs = max(self.map_secs, value)
+            else:
+                setattr(self, key, getattr(self, key) + value)
+
+    def to_dao(
+        self,
+        doc_id: str,
+        pages_count: int,
+        stats: dict,
+        decode_type: str,
+        reduce_mode: str,
+        task_retries: int,
+    ) -> DocumentProfileDAO:
+        latencies = sorted(page["secs"] for page in self.pages if page["attempts"])
+        return DocumentProfileDAO(
+            document_id=UUID(doc_id),
+            finished_at=func.now(),
+            decode_type=decode_type,
+            reduce_mode=reduce_mode,
+            pages_count=pages_count,
+            blank_pages=stats.get("blank_pages", 0),
+            text_pages=stats.get("text_pages", 0),
+            task_retries=task_retries,
+            map_retries=self.map_retries,
+            llm_calls=self.llm_calls,
+            prompt_tokens=self.prompt_tokens,
+            completion_tokens=self.completion_tokens,
+            rasterize_secs=self.rasterize_secs,
+            map_secs=self.map_secs,
+            map_latency_p50=_quantile(latencies, 0.5),
+            map_latency_p95=_quantile(latencies, 0.95),
+            reduce_secs=self.reduce_secs,
+            total_secs=time.time() - self.started_at,
+            bytes_uploaded=self.bytes_uploaded,
+            pages=sorted(self.pages, key=lambda page: page["idx"]),
+        )
+
+
+# profile of the document processed by the current task, if any
+current_profile: ContextVar[Optional[DocumentProfile]] = ContextVar(
+    "current_profile", default=None
+)
+# tokens used by the page being mapped, set per page by `_map_pages`
+current_page_tokens: ContextVar[Optional[Dict[str, int]]] = ContextVar(
+    "current_page_tokens", default=None
+)
+
+
+def record_usage(prompt_tokens: int, completion_tokens: int) -> None:
+    profile = current_profile.get()
+    if profile is not None:
+        profile.add_usage(prompt_tokens, completion_tokens)
+
+    page_tokens = current_page_tokens.get()
+    if page_tokens is not None:
+        page_tokens["tokens"] += prompt_tokens + completion_tokens
+
+
+def record_rasterize(secs: float) -> None:
+    profile = current_profile.get()
+    if profile is not None:
+        profile.rasterize_secs += secs
+
+
+def _quantile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(q * 100) - 1]
@@ -0,0 +1,143 @@
+import time
+from typing import Optional
+
+from redis import asyncio as aioredis
+
+import settings
+from rate_limiter import state_redis
+
+
+PROGRESS_FIELDS = (
+    "pages_total",
+    "pages_rasterized",
+    "pages_mapped",
+    "reduce_started",
+    "eta",
+)
+
+
+class ProgressReporter:
+    """Progress of a document, published to a Redis hash and Celery state.
+
+    The counters live in the hash `progress:{doc_id}`, which is what the
+    backend serves to clients, so the tasks mapping pages of one document on
+    different workers add up. The ETA and the `PROGRESS` state of the
+    document task are refreshed by whichever task reports, at most once per
+    `interval` secs.
+    """
+
+    def __init__(
+        self,
+        task,
+        doc_id: str,
+        redis_client: aioredis.Redis,
+        ttl: int,
+        interval: float = 1.0,
+    ) -> None:
+        self.task = task
+        self.doc_id = doc_id
+        self.redis = redis_client
+        self.key = f"progress:{doc_id}"
+        self.ttl = ttl
+        self.interval = interval
+
+        self._published_at = 0.0
+
+    async def start(self, pages_total: int, pages_done: int = 0) -> None:
+        """:param pages_done: pages restored from the checkpoint."""
+        await self._set(
+            pages_total=pages_total,
+            pages_rasterized=pages_done,
+            pages_mapped=pages_done,
+            reduce_started=0,
+            eta="",
+            resumed=pages_done,
+            started_at=time.time(),
+        )
+        await self.publish(force=True)
+
+    async def page_rasterized(self) -> None:
+        await self._incr("pages_rasterized")
+
+    async def page_mapped(self) -> None:
+        await self._incr("pages_mapped")
+
+    async def start_reduce(self, pages_total: int) -> None:
+        await self._set(
+            pages_total=pages_total,
+            pages_rasterized=pages_total,
+            pages_mapped=pages_total,
+            reduce_started=1,
+            eta="",
+        )
+        await self.publish(force=True)
+
+    async def publish(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._published_at < self.interval:
+            return
+        self._published_at = now
+
+        try:
+            fields = await self.redis.hgetall(self.key)
+            fields = {k.decode(): v.decode() for k, v in fields.items()}
+
+            eta = self._eta(fields)
+            if eta is not None:
+                await self.redis.hset(self.key, "eta", eta)
+
+            progress = {
+                k: int(fields[k]) if fields.get(k) else None for k in PROGRESS_FIELDS
+            }
+            progress["reduce_started"] = bool(progress["reduce_started"])
+            progress["eta"] = eta
+            self.task.update_state(
+                task_id=self.doc_id, state="PROGRESS", meta=progress
+            )
+        except Exception as e:
+            print(f"Progress update error: {e}")
+
+    async def clear(self) -> None:
+        await self.redis.delete(self.key)
+
+    @staticmethod
+    def _eta(fields: dict) -> Optional[int]:
+        """Secs left for the map stage, from the page rate observed so far."""
+        if not fields.get("started_at") or fields.get("reduce_started") == "1":
+            return None
+
+        total, mapped = int(fields["pages_total"]), int(fields["pages_mapped"])
+        mapped_now = min(mapped, total) - int(fields["resumed"])
+        if mapped_now <= 0:
+            return None
+
+        per_page = (time.time() - float(fields["started_at"])) / mapped_now
+        return int(per_page * max(total - mapped, 0))
+
+    async def _set(self, **fields) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(self.key, mapping=fields)
+            pipe.expire(self.key, self.ttl)
+            await pipe.execute()
+
+    async def _incr(self, field: str) -> None:
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.hincrby(self.key, field, 1)
+                pipe.expire(self.key, self.ttl)
+                await pipe.execute()
+        except Exception as e:
+            print(f"Progress update error: {e}")
+            return
+
+        await self.publish()
+
+
+def get_progress(task, doc_id: str = None) -> ProgressReporter:
+    """:param doc_id: document the task works on, its own id by default."""
+    return ProgressReporter(
+        task,
+        doc_id or task.request.id,
+        state_redis,
+        settings.app_settings.CHECKPOINT_TTL,
+    )
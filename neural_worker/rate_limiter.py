@@ -0,0 +1,126 @@
+import asyncio
+import random
+
+from redis import asyncio as aioredis
+
+import settings
+
+
+# Refills every bucket from KEYS by the elapsed time and either takes the
+# requested amounts from all of them at once or returns how long (in secs)
+# the caller has to wait until every bucket has enough tokens.
+# ARGV holds a (capacity per minute, requested) pair for each key.
+ACQUIRE_SCRIPT = """
+local now_t = redis.call('TIME')
+local now = tonumber(now_t[1]) + tonumber(now_t[2]) / 1000000
+local wait = 0
+local levels = {}
+
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local requested = math.min(tonumber(ARGV[2 * i]), capacity)
+    local rate = capacity / 60
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    if tokens < requested then
+        wait = math.max(wait, (requested - tokens) / rate)
+    end
+    levels[i] = tokens - requested
+end
+
+if wait > 0 then
+    return tostring(wait)
+end
+
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', tostring(levels[i]), 'ts', tostring(now))
+    redis.call('EXPIRE', key, 120)
+end
+return '0'
+"""
+
+# Takes tokens unconditionally (the bucket may go negative), used to account
+# for the real usage reported by the provider after the call.
+CONSUME_SCRIPT = """
+local now_t = redis.call('TIME')
+local now = tonumber(now_t[1]) + tonumber(now_t[2]) / 1000000
+local capacity = tonumber(ARGV[1])
+local rate = capacity / 60
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - tonumber(ARGV[2])), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 120)
+return '0'
+"""
+
+MAX_SLEEP = 5  # secs
+
+
+class RateLimiter:
+    """Cluster-wide token bucket for LLM calls of a single model.
+
+    Buckets live in Redis, so every Celery process and node draws from the
+    same requests/min and tokens/min budget. A limit <= 0 disables the bucket.
+    """
+
+    def __init__(
+        self, model: str, rpm: int, tpm: int, redis_client: aioredis.Redis
+    ) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self.rpm_key = f"ratelimit:{model}:rpm"
+        self.tpm_key = f"ratelimit:{model}:tpm"
+
+        self._acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._consume = redis_client.register_script(CONSUME_SCRIPT)
+
+    def _buckets(self, tokens: int):
+        keys, args = [], []
+        if self.rpm > 0:
+            keys.append(self.rpm_key)
+            args.extend([self.rpm, 1])
+        if self.tpm > 0:
+            keys.append(self.tpm_key)
+            args.extend([self.tpm, tokens])
+        return keys, args
+
+    async def acquire(self, tokens: int) -> float:
+        """Block until one request worth `tokens` tokens fits the budget.
+
+        :return: total time spent waiting (secs).
+        """
+        keys, args = self._buckets(tokens)
+        if not keys:
+            return 0.0
+
+        waited = 0.0
+        while True:
+            wait = float(await self._acquire(keys=keys, args=args))
+            if wait <= 0:
+                return waited
+
+            # jitter spreads the wake-ups of concurrently throttled callers
+            sleep_for = min(wait, MAX_SLEEP) + random.uniform(0, 0.1)
+            await asyncio.sleep(sleep_for)
+            waited += sleep_for
+
+    async def consume(self, tokens: int) -> None:
+        """Charge tokens spent beyond the estimate passed to `acquire`."""
+        if self.tpm > 0 and tokens > 0:
+            await self._consume(keys=[self.tpm_key], args=[self.tpm, tokens])
+
+
+state_redis = aioredis.Redis.from_url(settings.redis_settings.STATE_URI)
+
+limiter = RateLimiter(
+    model=settings.app_settings.MODEL_NAME,
+    rpm=settings.app_settings.RATE_LIMIT_RPM,
+    tpm=settings.app_settings.RATE_LIMIT_TPM,
+    redis_client=state_redis,
+)
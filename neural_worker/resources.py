@@ -0,0 +1,129 @@
+from contextlib import contextmanager
+
+import billiard
+import boto3
+from botocore.config import Config
+from celery.signals import worker_process_init, worker_process_shutdown
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import settings
+from ocr_engine import engine
+from rate_limiter import state_redis
+from infrastructure.postgres import database
+
+
+class WorkerResources:
+    """Connections owned by one worker process for its whole lifetime.
+
+    Holds a single S3 client with a connection pool shared by the threads of
+    the process, the SQLAlchemy engine sized by `POSTGRES_POOL_SIZE` and
+    `POSTGRES_MAX_OVERFLOW`, and warms them up together with the OpenAI
+    client of `ocr_engine.engine` in `worker_process_init`, so the first task
+    of the process does not pay for the connection setup. Everything is also
+    created lazily, for pools which do not fork (solo, threads).
+
+    Also owns the `RASTER_PROCESSES` processes rasterizing the PDFs of the
+    tasks, see `utils._rasterize_pdf`. They are forked in
+    `worker_process_init`, before the process starts any threads. Celery
+    pool processes are daemonic, which `multiprocessing` does not allow to
+    have children, hence billiard.
+    """
+
+    def __init__(self) -> None:
+        self._s3_client = None
+        self._raster_pool = None
+
+    @property
+    def s3_client(self):
+        if self._s3_client is None:
+            self._s3_client = boto3.client(
+                "s3",
+                endpoint_url=settings.minio_settings.URI,
+                aws_access_key_id=settings.minio_settings.ROOT_USER,
+                aws_secret_access_key=settings.minio_settings.ROOT_PASSWORD,
+                config=Config(
+                    max_pool_connections=settings.app_settings.S3_MAX_CONNECTIONS,
+                    retries={"mode": "standard"},
+                ),
+            )
+        return self._s3_client
+
+    @property
+    def raster_pool(self):
+        """:return: None if rasterization runs in the calling thread."""
+        processes = settings.app_settings.RASTER_PROCESSES
+        if self._raster_pool is None and processes > 1:
+            self._raster_pool = billiard.Pool(processes)
+        return self._raster_pool
+
+    @contextmanager
+    def session(self) -> Session:
+        """Session scoped to a task, committed on success."""
+        session = database.session_factory()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def open(self) -> None:
+        # connections of the pool inherited from the parent belong to it
+        database.engine.dispose(close=False)
+        try:
+            self.raster_pool
+        except Exception as e:
+            print(f"Failed to start the rasterizer processes: {e}")
+
+        warm_ups = {
+            "S3": lambda: self.s3_client.head_bucket(
+                Bucket=settings.minio_settings.BUCKET
+            ),
+            "Postgres": self._ping_db,
+            "Redis": lambda: engine.run(state_redis.ping()),
+            "OpenAI": lambda: engine.client,
+        }
+        for name, warm_up in warm_ups.items():
+            try:
+                warm_up()
+            except Exception as e:
+                print(f"{name} warm-up failed: {e}")
+
+    def close(self) -> None:
+        try:
+            engine.run(state_redis.aclose())
+        except Exception as e:
+            print(f"Failed to close Redis connections: {e}")
+        engine.close()
+        database.engine.dispose()
+        if self._s3_client is not None:
+            self._s3_client.close()
+            self._s3_client = None
+        self.close_raster_pool()
+
+    def close_raster_pool(self) -> None:
+        if self._raster_pool is not None:
+            self._raster_pool.terminate()
+            self._raster_pool.join()
+            self._raster_pool = None
+
+    @staticmethod
+    def _ping_db() -> None:
+        with database.engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+
+resources = WorkerResources()
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    resources.open()
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    resources.close()
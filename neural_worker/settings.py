@@ -12,6 +12,72 @@ class NWSettings(BaseSettings):
     BASE_OPENAI_URL: str = ""
     MODEL_NAME: str = "gpt-4o"
 
+    RASTER_WINDOW: int = 4  # pages rendered at once
+    # processes rasterizing windows side by side, per worker process,
+    # <= 1 rasterizes in the task thread
+    RASTER_PROCESSES: int = 2
+    ENCODING_PROFILE: str = "default"  # see encoding.ENCODING_PROFILES
+
+    # pages detected as blank are not sent to the model
+    BLANK_DETECTION: bool = True
+    BLANK_INK_LEVEL: int = 160  # grayscale level below which a pixel is ink
+    BLANK_INK_RATIO: float = 0.002  # share of ink pixels
+    # widest ink mark of a blank page (e.g. a page number), share of its width
+    BLANK_MAX_MARK_WIDTH: float = 0.04
+    BLANK_MIN_STD: float = 2.0  # std of grayscale levels
+
+    # born-digital pages are decoded from their text layer, without vision
+    TEXT_LAYER: bool = True
+    TEXT_LAYER_MIN_CHARS: int = 200
+    TEXT_LAYER_MAX_MATH: float = 0.005  # share of math symbols
+    TEXT_LAYER_MIN_IMAGE: int = 64  # px, smaller embedded images are ignored
+
+    TEXT_CHUNK_TOKENS: int = 2_000  # map chunk size of the texts task
+    PAGES_PER_REQUEST: int = 1  # page images packed into one map request
+    MAP_CONCURRENCY: int = 64  # in-flight map requests per task
+    MAP_RETRIES: int = 3  # per page
+    MAP_BACKOFF: float = 2.0  # secs, doubled on every page retry
+    CHECKPOINT_TTL: int = 24 * 3600  # secs
+    # documents with more pages to map are spread over the workers, see
+    # celery_services._fan_out
+    FANOUT_MIN_PAGES: int = 64
+    FANOUT_BATCH_PAGES: int = 16  # pages per map task
+    # input of one reduce call, the model rewrites it, so keep it
+    # within the model's completion limit
+    REDUCE_MAX_TOKENS: int = 12_000
+    REDUCE_MODE: str = "auto"  # llm | local | auto
+    # the result is uploaded in parts while the reduce call streams,
+    # S3 does not accept parts smaller than 5 MiB
+    RESULT_PART_SIZE: int = 8 * 1024 * 1024  # bytes
+    PREVIEW_TTL: int = 3600  # secs, partial result readable by the backend
+    PREVIEW_MAX_BYTES: int = 256 * 1024  # head of the result kept in the preview
+
+    # shared AsyncOpenAI client of the worker process
+    LLM_CONCURRENCY: int = 256  # in-flight LLM requests per process
+    LLM_MAX_CONNECTIONS: int = 256
+    LLM_KEEPALIVE_CONNECTIONS: int = 64
+    LLM_KEEPALIVE_EXPIRY: float = 30.0  # secs
+    LLM_TIMEOUT: float = 180.0  # secs, per call
+
+    # cluster-wide LLM budget per model, <= 0 disables the limit
+    RATE_LIMIT_RPM: int = 500
+    RATE_LIMIT_TPM: int = 300_000
+    IMAGE_TOKENS: int = 800  # estimated prompt tokens per page image
+    COMPLETION_TOKENS: int = 1_500  # estimated completion tokens per call
+
+    # pooled S3 client of the worker process, shared by the upload threads
+    S3_MAX_CONNECTIONS: int = 32
+
+    # content-addressed cache of page OCR results
+    CACHE_ENABLED: bool = True
+    CACHE_MAX_ENTRIES: int = 100_000
+    CACHE_TTL: int = 7 * 24 * 3600  # secs
+    CACHE_S3_SPILL: bool = False
+
+    # Prometheus exporter of the main worker process, <= 0 disables it
+    METRICS_PORT: int = 9808
+    METRICS_DIR: str = "/tmp/nw_metrics"  # samples of the pool processes
+
     class Config(ToolConfig):
         env_prefix = "nw_"
 
@@ -20,12 +86,18 @@ class RedisSettings(BaseSettings):
     HOST: str = "redis"
     PORT: int = 6379
     CELERY_DB: int = 1
+    STATE_DB: int = 2
 
     @computed_field(return_type=str)
     @property
     def URI(self):
         return f"redis://{self.HOST}:{self.PORT}/{self.CELERY_DB}"
 
+    @computed_field(return_type=str)
+    @property
+    def STATE_URI(self):
+        return f"redis://{self.HOST}:{self.PORT}/{self.STATE_DB}"
+
     class Config(ToolConfig):
         env_prefix = "redis_"
 
@@ -0,0 +1,181 @@
+from redis import asyncio as aioredis
+
+import settings
+from metrics import to_thread
+
+
+class FenceStripper:
+    """Removes the code fence the model wraps its output in, chunk by chunk.
+
+    The head of the stream is held back until the opening fence can be
+    recognized, and the last few chars are held back until the end, since
+    they may turn out to be the closing fence.
+    """
+
+    def __init__(self, prefix: str, suffix: str) -> None:
+        self.prefix = prefix
+        self.suffix = suffix
+        self._head = ""
+        self._tail = ""
+        self._started = False
+
+    def feed(self, chunk: str) -> str:
+        if not self._started:
+            self._head += chunk
+            if len(self._head) <= len(self.prefix) and "\n" not in self._head:
+                return ""
+            chunk = self._strip_head(self._head)
+            self._started = True
+
+        self._tail += chunk
+        keep = len(self.suffix) + 8  # room for trailing whitespace
+        ready, self._tail = self._tail[:-keep], self._tail[-keep:]
+        return ready
+
+    def finish(self) -> str:
+        tail = self._tail if self._started else self._strip_head(self._head)
+        tail = tail.rstrip()
+        if tail.endswith(self.suffix):
+            tail = tail[: -len(self.suffix)]
+        return tail.rstrip("\n")
+
+    def _strip_head(self, head: str) -> str:
+        head = head.lstrip()
+        if head.startswith(self.prefix):
+            head = head[len(self.prefix) :]
+        return head.lstrip("\n")
+
+
+class ResultWriter:
+    """Streams the converted document to MinIO.
+
+    Text is encoded a slice at a time and buffered until a full part is
+    collected, which is then sent as a part of a multipart upload, so the
+    writer holds about one part in memory, even if the whole document is
+    written at once. Documents smaller than a part are stored with a single
+    `put_object`. The first `preview_max_bytes` written are also appended to
+    a Redis preview key, which stays readable while the upload is in
+    progress.
+    """
+
+    preview_chunk = 512  # bytes, batches the tiny deltas of a stream
+
+    def __init__(
+        self,
+        s3_client,
+        key: str,
+        redis_client: aioredis.Redis,
+        preview_key: str,
+        part_size: int,
+        preview_ttl: int,
+        preview_max_bytes: int,
+    ) -> None:
+        self.s3_client = s3_client
+        self.bucket = settings.minio_settings.BUCKET
+        self.key = key
+        self.redis = redis_client
+        self.preview_key = preview_key
+        self.part_size = part_size
+        self.preview_ttl = preview_ttl
+        self.preview_max_bytes = preview_max_bytes
+
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._preview = bytearray()
+        self._preview_started = False
+        self._preview_room = preview_max_bytes
+        self._upload_id = None
+        self._parts = []
+
+    async def write(self, text: str) -> None:
+        # a char takes up to 4 bytes, so that a slice never exceeds a part
+        step = max(self.part_size // 4, 1)
+        for start in range(0, len(text), step):
+            await self._write(text[start : start + step].encode("utf-8"))
+
+    async def _write(self, data: bytes) -> None:
+        self.bytes_written += len(data)
+        self._buffer.extend(data)
+
+        if self._preview_room > 0:
+            head = data[: self._preview_room]
+            if len(head) < len(data):
+                # do not cut a char in two
+                head = head.decode("utf-8", "ignore").encode("utf-8")
+                self._preview_room = 0
+            else:
+                self._preview_room -= len(head)
+            self._preview.extend(head)
+            if len(self._preview) >= self.preview_chunk or not self._preview_room:
+                await self._flush_preview()
+
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[: self.part_size])
+            del self._buffer[: self.part_size]
+            await to_thread(self._upload_part, part)
+
+    async def close(self) -> None:
+        await self._flush_preview()
+        if self._upload_id is None:
+            await to_thread(
+                self.s3_client.put_object,
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=bytes(self._buffer),
+                ContentType="text/markdown",
+            )
+        else:
+            if self._buffer:
+                await to_thread(self._upload_part, bytes(self._buffer))
+            await to_thread(
+                self.s3_client.complete_multipart_upload,
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+        self._buffer.clear()
+
+        # let readers of the preview switch to the stored document
+        await self.redis.expire(self.preview_key, 60)
+
+    async def abort(self) -> None:
+        if self._upload_id is not None:
+            await to_thread(
+                self.s3_client.abort_multipart_upload,
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+            )
+        await self.redis.delete(self.preview_key)
+
+    async def _flush_preview(self) -> None:
+        if not self._preview:
+            return
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            if self._preview_started:
+                pipe.append(self.preview_key, bytes(self._preview))
+            else:
+                # overwrite what an interrupted attempt has left behind
+                pipe.set(self.preview_key, bytes(self._preview))
+            pipe.expire(self.preview_key, self.preview_ttl)
+            await pipe.execute()
+        self._preview.clear()
+        self._preview_started = True
+
+    def _upload_part(self, part: bytes) -> None:
+        if self._upload_id is None:
+            self._upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType="text/markdown"
+            )["UploadId"]
+
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=part,
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
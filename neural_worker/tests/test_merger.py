@@ -0,0 +1,55 @@
+from merger import merge_pages
+
+
+def test_numbered_headings_are_kept():
+    pages = [f"## Problem {n}\n\nSolve equation {n}." for n in range(1, 6)]
+    merged, _ = merge_pages(pages, "md")
+    for n in range(1, 6):
+        assert f"## Problem {n}" in merged
+
+
+def test_latex_sections_are_kept():
+    pages = [f"\\section{{Part {n}}}\nText of part {n}." for n in range(1, 6)]
+    merged, _ = merge_pages(pages, "latex")
+    assert merged.count("\\section{") == 5
+
+
+def test_plain_numbered_lines_are_kept():
+    pages = [f"Problem {n}\nSolve equation {n}." for n in range(1, 6)]
+    merged, _ = merge_pages(pages, "md")
+    assert merged.count("Problem") == 5
+
+
+def test_single_line_pages_are_kept():
+    pages = ["Lorem ipsum dolor sit amet."] * 5
+    merged, _ = merge_pages(pages, "md")
+    assert merged.count("Lorem ipsum") == 5
+
+
+def test_long_repeated_lines_are_kept():
+    line = (
+        "This sentence is repeated on every page and is far too long for a "
+        "running header."
+    )
+    pages = [f"{line}\nBody of page {n}." for n in range(1, 6)]
+    merged, _ = merge_pages(pages, "md")
+    assert merged.count(line) == 5
+
+
+def test_running_headers_and_page_numbers_are_dropped():
+    pages = [
+        f"Journal of Tests | {n}\nBody of page {n}.\n{n}" for n in range(1, 6)
+    ]
+    merged, clean = merge_pages(pages, "md")
+    assert "Journal of Tests" not in merged
+    assert merged.splitlines()[0] == "Body of page 1."
+    assert merged.splitlines()[-1] == "Body of page 5."
+    assert clean
+
+
+def test_split_sentence_and_hyphenated_word_are_joined():
+    merged, clean = merge_pages(
+        ["The proof goes", "through, see the appen-", "dix."], "md"
+    )
+    assert merged == "The proof goes through, see the appendix."
+    assert clean
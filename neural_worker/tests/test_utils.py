@@ -0,0 +1,62 @@
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+import utils
+from utils import Page, is_blank_page
+
+# A4 at 200 dpi
+PAGE_SIZE = (1654, 2339)
+
+
+def _page(text: str = None, xy=(200, 300), size: int = 33) -> Image.Image:
+    img = Image.new("RGB", PAGE_SIZE, "white")
+    if text:
+        font = ImageFont.load_default(size=size)  # 33 px is 12 pt at 200 dpi
+        ImageDraw.Draw(img).text(xy, text, fill="black", font=font)
+    return img
+
+
+def _ink_ratio(img: Image.Image) -> float:
+    pixels = np.asarray(img.convert("L").reduce(2))
+    return np.count_nonzero(pixels < 160) / pixels.size
+
+
+def test_empty_page_is_blank():
+    assert is_blank_page(_page())
+
+
+def test_gray_scan_is_blank():
+    assert is_blank_page(Image.new("L", PAGE_SIZE, 200))
+
+
+def test_page_number_is_blank():
+    assert is_blank_page(_page("12", xy=(810, 2200), size=28))
+
+
+def test_one_line_page_is_not_blank():
+    img = _page("This concludes the proof of Theorem 3.")
+    # as sparse as a page number by ink alone
+    assert _ink_ratio(img) < 0.002
+    assert not is_blank_page(img)
+
+
+def test_page_number_with_specks_is_blank():
+    img = _page("7", xy=(810, 2200), size=28)
+    draw = ImageDraw.Draw(img)
+    for x, y in ((100, 100), (1500, 900), (400, 1800), (1200, 2000)):
+        draw.rectangle((x, y, x + 3, y + 3), fill="black")
+    assert is_blank_page(img)
+
+
+def test_window_pages_stay_in_document_order(monkeypatch):
+    monkeypatch.setattr(utils.settings.app_settings, "TEXT_LAYER", True)
+    monkeypatch.setattr(
+        utils, "_text_layer_pages", lambda pdf_path, run: {1: "text", 3: "text"}
+    )
+    monkeypatch.setattr(
+        utils,
+        "_render_pages",
+        lambda pdf_path, run, profile, timings: [Page(idx, "image") for idx in run],
+    )
+    pages, _ = utils._rasterize_window("doc.pdf", [0, 1, 2, 3, 4], None, 4)
+    assert [page.idx for page in pages] == [0, 1, 2, 3, 4]
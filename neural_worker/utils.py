@@ -1,26 +1,333 @@
-from io import BytesIO
-import base64
+import re
+import subprocess
+import time
+import unicodedata
+from collections import deque
+from tempfile import NamedTemporaryFile
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
 
-from pdf2image import convert_from_bytes
+import numpy as np
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image
 
+import settings
+from encoding import EncodingProfile, encode_page, get_profile
+from metrics import RASTERIZE_SECONDS
+from profiling import record_rasterize
+from resources import resources
 
-def process_file(byte_data, file_type):
+
+class Page(NamedTuple):
+    idx: int
+    kind: str  # image | text | blank
+    content: Optional[str] = None  # image data URL or extracted text
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 chars per token), no tokenizer needed."""
+    return len(text or "") // 4 + 1
+
+
+def split_text(text: str, max_tokens: int) -> List[str]:
+    """Split text into chunks of at most `max_tokens` on paragraph boundaries."""
+    chunks, chunk, chunk_tokens = [], [], 0
+    for paragraph in _split_paragraphs(text, max_tokens):
+        tokens = estimate_tokens(paragraph)
+        if chunk and chunk_tokens + tokens > max_tokens:
+            chunks.append("\n\n".join(chunk))
+            chunk, chunk_tokens = [], 0
+        chunk.append(paragraph)
+        chunk_tokens += tokens
+
+    if chunk:
+        chunks.append("\n\n".join(chunk))
+
+    return chunks
+
+
+def _split_paragraphs(text: str, max_tokens: int):
+    max_chars = 4 * max_tokens
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip("\n")
+        if not paragraph.strip():
+            continue
+        if estimate_tokens(paragraph) <= max_tokens:
+            yield paragraph
+            continue
+
+        # oversized paragraph, fall back to lines and then to plain slices
+        for line in paragraph.splitlines():
+            for start in range(0, len(line), max_chars):
+                yield line[start : start + max_chars]
+
+
+def is_blank_page(img: Image.Image) -> bool:
+    """Cheap check for blank pages, back sides and lone page numbers.
+
+    The page is blank if its brightness barely varies (e.g. a uniformly gray
+    scan), or if almost no pixels are dark (ink ratio) and none of the ink
+    marks is wider than a page number, so that a single short line of text
+    is kept.
+    """
+    pixels = np.asarray(img.convert("L").reduce(2), dtype=np.uint8)
+    if pixels.std() < settings.app_settings.BLANK_MIN_STD:
+        return True
+
+    ink = pixels < settings.app_settings.BLANK_INK_LEVEL
+    if np.count_nonzero(ink) / ink.size >= settings.app_settings.BLANK_INK_RATIO:
+        return False
+
+    max_width = settings.app_settings.BLANK_MAX_MARK_WIDTH * ink.shape[1]
+    return _widest_mark(ink, gap=ink.shape[1] // 100) <= max_width
+
+
+def _widest_mark(ink: np.ndarray, gap: int) -> int:
+    """Width in px of the widest mark of a sparse ink mask.
+
+    A mark is a run of ink columns within a band of consecutive ink rows,
+    gaps up to `gap` px (e.g. between words) are bridged.
+    """
+    widest = 0
+    for rows in _runs(np.flatnonzero(ink.any(axis=1)), gap=1):
+        cols = np.flatnonzero(ink[rows[0] : rows[-1] + 1].any(axis=0))
+        for run in _runs(cols, gap):
+            widest = max(widest, int(run[-1] - run[0]) + 1)
+    return widest
+
+
+def _runs(indexes: np.ndarray, gap: int) -> List[np.ndarray]:
+    """Split sorted indexes where they are more than `gap` apart."""
+    if not indexes.size:
+        return []
+    return np.split(indexes, np.flatnonzero(np.diff(indexes) > gap + 1) + 1)
+
+
+def process_file(
+    byte_data, file_type, skip: Iterable[int] = (), profile: EncodingProfile = None
+):
+    """:return: pages count and a lazy iterator over the rendered pages."""
     estimator_dict = {
         "pdf": process_pdf,
     }
 
     estimator = estimator_dict[file_type]
-    data = estimator(byte_data)
+    data = estimator(byte_data, skip=skip, profile=profile)
 
     return data
 
 
-def process_pdf(byte_data):
-    pdf_imgs = convert_from_bytes(byte_data)
-    pdf_base64 = []
-    for img in pdf_imgs:
-        buffered = BytesIO()
-        img.save(buffered, format="JPEG")
-        pdf_base64.append(base64.b64encode(buffered.getvalue()).decode())
+def process_pdf(
+    byte_data,
+    skip: Iterable[int] = (),
+    profile: EncodingProfile = None,
+    window: int = None,
+):
+    """Rasterize PDF lazily, see `_rasterize_pdf`.
+
+    Pages whose indexes are in `skip` (e.g. already processed) are not
+    rendered at all.
+    """
+    pdf_file = NamedTemporaryFile(suffix=".pdf")
+    try:
+        pdf_file.write(byte_data)
+        pdf_file.flush()
+        pages_count = pdfinfo_from_path(pdf_file.name)["Pages"]
+    except Exception:
+        pdf_file.close()
+        raise
+
+    skip = set(skip)
+    pages = [idx for idx in range(pages_count) if idx not in skip]
+    profile = profile or get_profile(settings.app_settings.ENCODING_PROFILE)
+    window = window or settings.app_settings.RASTER_WINDOW
+
+    return pages_count, _rasterize_pdf(pdf_file, pages, profile, window)
+
+
+def _page_windows(pages: List[int], window: int):
+    """Split sorted page indexes into runs of consecutive pages."""
+    run = []
+    for idx in pages:
+        if run and (idx != run[-1] + 1 or len(run) == window):
+            yield run
+            run = []
+        run.append(idx)
+    if run:
+        yield run
+
+
+def _rasterize_pdf(
+    pdf_file, pages: List[int], profile: EncodingProfile, window: int
+):
+    """Yield `Page`s of the document.
+
+    Born-digital pages with a usable text layer are yielded as text without
+    rendering them. The rest is rendered `window` pages at a time. Windows
+    are rasterized and encoded side by side in the processes of
+    `resources.raster_pool`, at most two per process ahead of the consumer,
+    so only a bounded number of encoded pages is held in memory regardless
+    of the document length. Without the pool the windows are rasterized one
+    by one in the calling thread.
+    """
+    pool = resources.raster_pool
+    with pdf_file:
+        windows = _page_windows(pages, window)
+        if pool is None:
+            for run in windows:
+                yield from _observe_window(
+                    *_rasterize_window(pdf_file.name, run, profile, window)
+                )
+            return
+
+        pending = deque()
+        for run in windows:
+            pending.append(
+                pool.apply_async(
+                    _rasterize_window, (pdf_file.name, run, profile, window)
+                )
+            )
+            if len(pending) >= 2 * settings.app_settings.RASTER_PROCESSES:
+                yield from _observe_window(*pending.popleft().get())
+
+        while pending:
+            yield from _observe_window(*pending.popleft().get())
+
+
+def _rasterize_window(
+    pdf_path: str, run: List[int], profile: EncodingProfile, window: int
+) -> Tuple[List[Page], Dict[str, Tuple[float, int]]]:
+    """Text layer extraction, rendering and encoding of a window of pages.
+
+    Runs in the rasterizer pool, only the encoded pages are sent back.
+
+    :return: pages and the time and page count of every stage.
+    """
+    pages, timings = [], {}
+    scanned_pages = run
+    if settings.app_settings.TEXT_LAYER:
+        start = time.perf_counter()
+        text_pages = _text_layer_pages(pdf_path, run)
+        timings["text_layer"] = (time.perf_counter() - start, len(run))
+        pages += [Page(idx, "text", text) for idx, text in text_pages.items()]
+        scanned_pages = [idx for idx in run if idx not in text_pages]
+
+    for scanned_run in _page_windows(scanned_pages, window):
+        pages += _render_pages(pdf_path, scanned_run, profile, timings)
+
+    # text layer pages were collected first, keep the document order
+    pages.sort(key=lambda page: page.idx)
+    return pages, timings
+
+
+def _render_pages(
+    pdf_path: str,
+    run: List[int],
+    profile: EncodingProfile,
+    timings: Dict[str, Tuple[float, int]],
+) -> List[Page]:
+    start = time.perf_counter()
+    pdf_imgs = convert_from_path(
+        pdf_path,
+        dpi=profile.dpi,
+        grayscale=profile.grayscale,
+        first_page=run[0] + 1,
+        last_page=run[-1] + 1,
+    )
+    _add_timing(timings, "render", time.perf_counter() - start, len(run))
+
+    pages = []
+    for idx, img in zip(run, pdf_imgs):
+        start = time.perf_counter()
+        if settings.app_settings.BLANK_DETECTION and is_blank_page(img):
+            pages.append(Page(idx, "blank"))
+        else:
+            pages.append(Page(idx, "image", encode_page(img, profile)))
+        img.close()
+        _add_timing(timings, "encode", time.perf_counter() - start, 1)
+
+    return pages
+
+
+def _add_timing(timings: dict, stage: str, secs: float, pages: int) -> None:
+    total_secs, total_pages = timings.get(stage, (0.0, 0))
+    timings[stage] = (total_secs + secs, total_pages + pages)
+
+
+def _observe_window(pages: List[Page], timings: Dict[str, Tuple[float, int]]):
+    """Record the timings of a window and yield its pages."""
+    for stage, (secs, count) in timings.items():
+        record_rasterize(secs)
+        # spread the time of a stage evenly over its pages
+        histogram = RASTERIZE_SECONDS.labels(stage)
+        for _ in range(count):
+            histogram.observe(secs / count)
+
+    yield from pages
+
+
+def _text_layer_pages(pdf_path: str, run: List[int]) -> Dict[int, str]:
+    """Pages of the run which can be decoded from their embedded text.
+
+    A page qualifies if its text layer is long enough and readable, and it
+    has neither embedded images nor a noticeable share of math symbols,
+    which the text layer does not represent faithfully.
+    """
+    first_page, last_page = run[0] + 1, run[-1] + 1
+    try:
+        texts = subprocess.run(
+            ["pdftotext", "-layout", "-f", str(first_page), "-l", str(last_page)]
+            + [pdf_path, "-"],
+            capture_output=True,
+            check=True,
+            timeout=60,
+        ).stdout.decode("utf-8", errors="replace")
+        images = _pages_with_images(pdf_path, first_page, last_page)
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"Text layer extraction failed: {e}")
+        return {}
+
+    text_pages = {}
+    for idx, text in zip(run, texts.split("\f")):
+        if idx + 1 not in images and _is_text_page(text):
+            text_pages[idx] = text.strip("\n")
+
+    return text_pages
+
+
+def _pages_with_images(pdf_path: str, first_page: int, last_page: int) -> Set[int]:
+    min_size = settings.app_settings.TEXT_LAYER_MIN_IMAGE
+    listing = subprocess.run(
+        ["pdfimages", "-list", "-f", str(first_page), "-l", str(last_page)]
+        + [pdf_path],
+        capture_output=True,
+        check=True,
+        timeout=60,
+    ).stdout.decode()
+
+    pages = set()
+    # skip the table header and its underline
+    for row in listing.splitlines()[2:]:
+        cols = row.split()
+        if len(cols) > 4 and int(cols[3]) >= min_size and int(cols[4]) >= min_size:
+            pages.add(int(cols[0]))
+
+    return pages
+
+
+def _is_text_page(text: str) -> bool:
+    chars = [ch for ch in text if not ch.isspace()]
+    if len(chars) < settings.app_settings.TEXT_LAYER_MIN_CHARS:
+        return False
+
+    unreadable = sum(ch == "\ufffd" or not ch.isprintable() for ch in chars)
+    math = sum(
+        unicodedata.category(ch) == "Sm"
+        or "\u0370" <= ch <= "\u03ff"  # greek
+        or "\U0001d400" <= ch <= "\U0001d7ff"  # math alphanumerics
+        for ch in chars
+    )
 
-    return pdf_base64
+    return (
+        unreadable / len(chars) < 0.01
+        and math / len(chars) <= settings.app_settings.TEXT_LAYER_MAX_MATH
+    )